@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, render_template, url_for
-from model import features_for_prediction
+import time
+STARTUP_START = time.time()
+
+from flask import Flask, Response, request, render_template, url_for, jsonify, abort
+from model import features_for_prediction, feature_cache, startup_times
+from feature_store import get_feature_store
+from bulk import format_prediction, get_prediction, predict_batch, rank, get_scoring_pool
+from serving import get_serving_executor, get_micro_batcher, Overloaded, DeadlineExceeded, Cancelled
+from metrics import stage_metrics
+from cascade import get_cascade
+from retrieval import get_sentence_index, search
 
 import logging
 import os
@@ -12,22 +21,92 @@ MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
 
 PORT = 5000
 
+# Batches with fewer pairs are scored in the web process, the pool overhead is not worth it
+SCORING_POOL_MIN_BATCH = int(os.environ.get('SCORING_POOL_MIN_BATCH', 16))
+
+# Batches run on the serving executor check their deadline after every chunk of this many pairs,
+# on the scoring pool after every round of full chunks for all workers
+CANCEL_CHECK_BATCH = 16
+
 app = Flask(__name__)
 logging.basicConfig(filename='classifier.log', level=logging.DEBUG)
 
+t = time.time()
 model_v = joblib.load(MODEL_V)
+startup_times['model_v'] = time.time() - t
+feature_cache.store = get_feature_store(MODEL_V)
+cascade = get_cascade(model_v)
+sentence_index = get_sentence_index()
+executor = get_serving_executor()
+
+
+def score_pairs(pairs):
+    """
+    Score pairs with model_v, or with the cascade if CASCADE_THRESHOLD is set
+    """
+    if cascade is not None:
+        return cascade.predict_batch(pairs)
+    return predict_batch(model_v, pairs)
+
+
+batcher = get_micro_batcher(score_pairs)
+
+logging.info('Startup in %.3fs (%s), pid %d', time.time() - STARTUP_START,
+             ', '.join('%s %.3fs' % item for item in startup_times.items()), os.getpid())
+
+
+def get_serving_metrics():
+    """
+    Queue and cache state for /metrics, see StageMetrics.add_source
+    """
+    metrics = []
+    if executor is not None:
+        stats = executor.get_stats()
+        metrics += [
+            ('paraphrase_executor_queued', 'gauge', 'Requests waiting for a scoring thread', stats['queued']),
+            ('paraphrase_executor_running', 'gauge', 'Requests being scored', stats['running']),
+            ('paraphrase_executor_rejected_total', 'counter', 'Requests rejected with 503', stats['rejected']),
+            ('paraphrase_executor_timeouts_total', 'counter', 'Requests failed with 504', stats['timeouts']),
+        ]
+    if batcher is not None:
+        stats = batcher.get_stats()
+        metrics += [
+            ('paraphrase_micro_batch_fill_rate', 'gauge', 'Mean batch size / max batch size', stats['fill_rate']),
+            ('paraphrase_micro_batches_total', 'counter', 'Processed micro batches', stats['batches']),
+        ]
+    if cascade is not None:
+        stats = cascade.get_stats()
+        metrics += [
+            ('paraphrase_cascade_pairs_total', 'counter', 'Pairs scored by the cascade', stats['pairs']),
+            ('paraphrase_cascade_early_exits_total', 'counter', 'Pairs decided by the first stage', stats['early_exits']),
+        ]
+    for level, stats in feature_cache.get_stats().items():
+        if level == 'store':
+            continue
+        metrics += [
+            ('paraphrase_cache_%s_hits_total' % level, 'counter', 'Feature cache hits', stats['hits']),
+            ('paraphrase_cache_%s_misses_total' % level, 'counter', 'Feature cache misses', stats['misses']),
+            ('paraphrase_cache_%s_bytes' % level, 'gauge', 'Feature cache size', stats['size']),
+        ]
+    return metrics
+
 
+stage_metrics.add_source(get_serving_metrics)
+
+
+def predict_v(s1, s2, cancelled=None):
+    if batcher is not None:
+        # Scored together with pairs of concurrent requests
+        return batcher.submit((s1, s2), cancelled)
+    if cascade is not None:
+        return cascade.predict_batch([(s1, s2)])[0]
 
-def predict_v(s1, s2):
     features = features_for_prediction(s1, s2)
-    is_paraphrase = model_v.predict(features)[0] == 1
-    probabilities = model_v._predict_proba_lr(features)
-
-    return {
-        'is_paraphrase': is_paraphrase,
-        'not_paraphrase_probability': int(round(probabilities[0][0] * 100)),
-        'paraphrase_probability': int(round(probabilities[0][1] * 100)),
-    }
+    with stage_metrics.timer('classifier'):
+        predictions = model_v.predict(features)
+        probabilities = model_v._predict_proba_lr(features)
+
+    return get_prediction(predictions[0], probabilities[0])
     # return {
     #     'is_paraphrase': 0,
     #     'not_paraphrase_probability': 0,
@@ -35,6 +114,106 @@ def predict_v(s1, s2):
     # }
 
 
+def predict_v_batch(pairs, cancelled=None):
+    """
+    pairs - list of (s1, s2)
+    cancelled - Optional threading.Event, checked between chunks of pairs
+    Return list of get_prediction results, large batches are scored on the process pool if SCORING_WORKERS is set
+    """
+    pool = get_scoring_pool()
+    if pool is not None and len(pairs) >= SCORING_POOL_MIN_BATCH:
+        score = pool.score
+        # Every pool.score call is a map round, between two checks every worker gets a full chunk
+        check_batch = pool.workers * pool.chunk_size
+    else:
+        score = score_pairs
+        check_batch = CANCEL_CHECK_BATCH
+
+    if cancelled is None:
+        return score(pairs)
+
+    results = []
+    for start in range(0, len(pairs), check_batch):
+        if cancelled.is_set():
+            raise Cancelled()
+        results += score(pairs[start:start + check_batch])
+    return results
+
+
+def search_v(sentence, top_k, candidates, min_probability, cancelled=None):
+    """
+    Candidates of sentence from sentence_index scored with predict_v_batch
+    """
+    return search(sentence_index, sentence, lambda pairs: predict_v_batch(pairs, cancelled), top_k, candidates,
+                  min_probability)
+
+
+def run_bounded(fn, *args):
+    """
+    Run fn on the serving executor if SERVING_QUEUE_DEPTH is set:
+    503 if the queue is full, 504 if the result is not ready before the deadline
+    """
+    if executor is None:
+        return fn(*args)
+    try:
+        return executor.run(fn, *args)
+    except Overloaded:
+        abort(503)
+    except DeadlineExceeded:
+        abort(504)
+
+
+def is_sentence(value):
+    """
+    Sentences without any token can not be analysed (no ROOT node, zero length)
+    """
+    return isinstance(value, str) and bool(value.strip())
+
+
+def get_pairs_from_json(data):
+    """
+    Expects {"pairs": [{"first-sentence": "...", "second-sentence": "..."}, ...]},
+    both sentences of every pair are required and must not be blank
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('pairs'), list):
+        abort(400)
+
+    pairs = []
+    for item in data['pairs']:
+        if not isinstance(item, dict):
+            abort(400)
+        first_sentence = item.get('first-sentence')
+        second_sentence = item.get('second-sentence')
+        if not is_sentence(first_sentence) or not is_sentence(second_sentence):
+            abort(400)
+        pairs.append((first_sentence, second_sentence))
+
+    return pairs
+
+
+def get_ranking_from_json(data):
+    """
+    Expects {"sentence": "...", "candidates": ["...", ...], "top-k": 10, "min-probability": 50},
+    top-k and min-probability (percent) are optional, the sentence and candidates must not be blank
+    """
+    if not isinstance(data, dict):
+        abort(400)
+    sentence = data.get('sentence')
+    candidates = data.get('candidates')
+    top_k = data.get('top-k')
+    min_probability = data.get('min-probability')
+    if not is_sentence(sentence) or not isinstance(candidates, list):
+        abort(400)
+    if not all(is_sentence(candidate) for candidate in candidates):
+        abort(400)
+    if top_k is not None and (not isinstance(top_k, int) or top_k < 0):
+        abort(400)
+    if min_probability is not None and not isinstance(min_probability, (int, float)):
+        abort(400)
+
+    return sentence, candidates, top_k, min_probability
+
+
 @app.route('/')
 def test2():
     return render_template('m_index.html')
@@ -42,12 +221,71 @@ def test2():
 
 @app.route('/compare-sentences')
 def compare_sentences():
-    first_sentence = request.args.get('first-sentence', '')
-    second_sentence = request.args.get('second-sentence', '')
-    similarity = predict_v(first_sentence, second_sentence)
+    first_sentence = request.args.get('first-sentence')
+    second_sentence = request.args.get('second-sentence')
+    # Blank sentences never reach a micro batch shared with other requests
+    if not is_sentence(first_sentence) or not is_sentence(second_sentence):
+        abort(400)
+    similarity = format_prediction(run_bounded(predict_v, first_sentence, second_sentence))
     return render_template('compare-sentences.html', first_sentence=first_sentence,
                            second_sentence=second_sentence, similarity=similarity)
 
 
+@app.route('/api/compare-sentences', methods=['POST'])
+def compare_sentences_batch():
+    pairs = get_pairs_from_json(request.get_json(silent=True))
+    return jsonify({'results': [format_prediction(result) for result in run_bounded(predict_v_batch, pairs)]})
+
+
+@app.route('/api/rank-sentences', methods=['POST'])
+def rank_sentences():
+    sentence, candidates, top_k, min_probability = get_ranking_from_json(request.get_json(silent=True))
+    # The query is analysed once, its tree, vectors and path/subtree aggregates are shared by all pairs
+    results = run_bounded(predict_v_batch, [(sentence, candidate) for candidate in candidates])
+    return jsonify({'results': rank(candidates, results, top_k, min_probability)})
+
+
+@app.route('/api/search-sentences', methods=['POST'])
+def search_sentences():
+    """
+    Expects {"sentence": "...", "top-k": 10, "candidates": 100, "min-probability": 50}, the sentence must not be blank,
+    candidates from SENTENCE_INDEX_PATH are reranked with the classifier
+    """
+    if sentence_index is None:
+        abort(404)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not is_sentence(data.get('sentence')):
+        abort(400)
+    top_k = data.get('top-k', 10)
+    candidates = data.get('candidates', 100)
+    min_probability = data.get('min-probability')
+    if not isinstance(top_k, int) or not isinstance(candidates, int) or top_k < 0 or candidates < 0:
+        abort(400)
+    if min_probability is not None and not isinstance(min_probability, (int, float)):
+        abort(400)
+
+    results = run_bounded(search_v, data['sentence'], top_k, candidates, min_probability)
+    return jsonify({'results': results})
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return jsonify(feature_cache.get_stats())
+
+
+@app.route('/serving-stats')
+def serving_stats():
+    return jsonify({
+        'executor': executor.get_stats() if executor is not None else None,
+        'micro_batcher': batcher.get_stats() if batcher is not None else None,
+        'cascade': cascade.get_stats() if cascade is not None else None,
+    })
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(stage_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=PORT, debug=True)
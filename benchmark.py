@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Latency benchmark over the MSRP test pairs.
+
+    python benchmark.py [--pairs N] [--output results.json] [--baseline benchmark_baseline.json]
+    python benchmark.py --update-baseline
+
+Pairs are replayed through features_for_prediction with an empty feature cache (spaCy parse included)
+and through every AllFeatureFinal generator on its own (on already parsed sentences, nothing memoized
+between generators). For every target p50/p95/p99 latency, pairs/sec and peak RSS are reported,
+latencies are also split by the length of the longer sentence of the pair.
+
+With --baseline results are compared with a stored run, exit code is 1 if any target got slower
+than --threshold.
+"""
+import sys
+import os
+import argparse
+import json
+import logging
+import platform
+import random
+import resource
+import time
+
+import numpy as np
+
+import model
+from model import AllFeatureFinal, DataGenerator, FeatureCache, FEATURES_VERSION, SentenceAnalysis, nlp
+from metrics import stage_metrics
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_BASELINE = os.path.join(APP_ROOT, 'benchmark_baseline.json')
+
+# Upper bounds of length buckets, in tokens of the longer sentence of the pair
+LENGTH_BUCKETS = [15, 25, 35]
+
+# Compared with the baseline, lower is better for all but pairs_per_sec
+COMPARED_METRICS = ['p50', 'p95', 'p99', 'pairs_per_sec']
+
+logger = logging.getLogger(__name__)
+
+
+def get_pairs(count=None, seed=0):
+    """
+    Return list of (s1, s2), a seeded sample of count test pairs (all by default) in file order
+    """
+    data = DataGenerator.get_test_data()
+    indexes = list(range(len(data)))
+    if count is not None and count < len(data):
+        indexes = sorted(random.Random(seed).sample(indexes, count))
+    return [(data[i]['s1'], data[i]['s2']) for i in indexes]
+
+
+def get_length_bucket(doc1, doc2):
+    length = max(len(doc1), len(doc2))
+    low = 0
+    for high in LENGTH_BUCKETS:
+        if length <= high:
+            return '%d-%d' % (low + 1, high)
+        low = high
+    return '>%d' % low
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.
+
+
+def get_latency_stats(times):
+    times = np.array(times)
+    if len(times) == 0:
+        return {'count': 0}
+    return {
+        'count': len(times),
+        'mean': float(times.mean()),
+        'p50': float(np.percentile(times, 50)),
+        'p95': float(np.percentile(times, 95)),
+        'p99': float(np.percentile(times, 99)),
+    }
+
+
+def run_target(run_pair, pairs, buckets, warmup):
+    """
+    run_pair - Function that takes pair index and computes its features
+    Return stats of one target, warmup pairs are run first and not counted
+    """
+    for index in range(min(warmup, len(pairs))):
+        run_pair(index)
+
+    times = []
+    started = time.perf_counter()
+    for index in range(len(pairs)):
+        start = time.perf_counter()
+        run_pair(index)
+        times.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+
+    stats = get_latency_stats(times)
+    stats['pairs_per_sec'] = len(pairs) / elapsed
+    # Peak of the whole process so far, targets run in order, so it does not go down
+    stats['peak_rss_mb'] = get_peak_rss_mb()
+    stats['buckets'] = {
+        bucket: get_latency_stats([t for t, b in zip(times, buckets) if b == bucket])
+        for bucket in sorted(set(buckets))
+    }
+    return stats
+
+
+def run_benchmark(pairs, targets=None, warmup=5):
+    """
+    targets - Names of targets to run: 'features_for_prediction' and generator NAMEs, all by default
+    Return dict with meta and results per target
+    """
+    sentences = list(dict.fromkeys(s for pair in pairs for s in pair))
+    docs = dict(zip(sentences, nlp.pipe(sentences)))
+    buckets = [get_length_bucket(docs[s1], docs[s2]) for s1, s2 in pairs]
+
+    results = {}
+
+    if targets is None or 'features_for_prediction' in targets:
+        logger.info('Running features_for_prediction')
+        cache = model.feature_cache
+        # Nothing fits into the cache, every pair is parsed and computed
+        model.feature_cache = FeatureCache(0, 0)
+        try:
+            results['features_for_prediction'] = run_target(
+                lambda index: model.features_for_prediction(*pairs[index]), pairs, buckets, warmup
+            )
+        finally:
+            model.feature_cache = cache
+
+    for generator in AllFeatureFinal().get_generators():
+        if targets is not None and generator.NAME not in targets:
+            continue
+        logger.info('Running %s', generator.NAME)
+
+        def run_pair(index, generator=generator):
+            s1, s2 = pairs[index]
+            return generator.get_features(SentenceAnalysis(s1, docs[s1]), SentenceAnalysis(s2, docs[s2]))
+
+        results[generator.NAME] = run_target(run_pair, pairs, buckets, warmup)
+
+    return {
+        'meta': {
+            'pairs': len(pairs),
+            'warmup': warmup,
+            'features_version': FEATURES_VERSION,
+            'metrics_enabled': stage_metrics.enabled,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Return list of (target, metric, baseline value, value, relative change, is_regression)
+    for targets present in both runs
+    """
+    rows = []
+    for target, stats in results['results'].items():
+        base = baseline['results'].get(target)
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in stats or metric not in base or base[metric] == 0:
+                continue
+            change = (stats[metric] - base[metric]) / base[metric]
+            if metric == 'pairs_per_sec':
+                is_regression = change < -threshold
+            else:
+                is_regression = change > threshold
+            rows.append((target, metric, base[metric], stats[metric], change, is_regression))
+    return rows
+
+
+def print_results(results):
+    print('%-35s %8s %8s %8s %10s %8s' % ('target', 'p50 ms', 'p95 ms', 'p99 ms', 'pairs/sec', 'RSS MB'))
+    for target, stats in results['results'].items():
+        print('%-35s %8.2f %8.2f %8.2f %10.1f %8.0f' % (
+            target, stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000,
+            stats['pairs_per_sec'], stats['peak_rss_mb'],
+        ))
+        for bucket, bucket_stats in stats['buckets'].items():
+            print('  %-33s %8.2f %8.2f %8.2f %10s (%d pairs)' % (
+                bucket + ' tokens', bucket_stats['p50'] * 1000, bucket_stats['p95'] * 1000,
+                bucket_stats['p99'] * 1000, '', bucket_stats['count'],
+            ))
+
+
+def print_comparison(rows):
+    print('%-35s %-14s %12s %12s %8s' % ('target', 'metric', 'baseline', 'current', 'change'))
+    for target, metric, base, value, change, is_regression in rows:
+        print('%-35s %-14s %12.5f %12.5f %+7.1f%%%s' % (
+            target, metric, base, value, change * 100, ' REGRESSION' if is_regression else '',
+        ))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Latency benchmark over the MSRP test pairs')
+    parser.add_argument('--pairs', type=int, default=200, help='Number of sampled test pairs, 0 - all')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=5, help='Pairs run before timing every target')
+    parser.add_argument('--targets', nargs='*', default=None,
+                        help='features_for_prediction and/or generator NAMEs, all by default')
+    parser.add_argument('--output', default=None, help='Write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare with results stored in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as regression')
+    parser.add_argument('--update-baseline', action='store_true', help='Write results to %s' % BENCHMARK_BASELINE)
+    args = parser.parse_args()
+
+    pairs = get_pairs(args.pairs or None, args.seed)
+    results = run_benchmark(pairs, args.targets, args.warmup)
+    print_results(results)
+
+    for path in [args.output, BENCHMARK_BASELINE if args.update_baseline else None]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print('Saved to %s' % path)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta']['pairs'] != results['meta']['pairs']:
+            print('Baseline was run on %d pairs, current run on %d' % (baseline['meta']['pairs'], len(pairs)))
+        rows = compare(results, baseline, args.threshold)
+        print_comparison(rows)
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk scoring of sentence pairs on a pool of worker processes.
+
+Every worker loads nlp, idf_model (on import of model) and the classifier once,
+pairs are split into chunks and results are returned in input order.
+
+    python bulk.py [--workers N] [--input pairs.tsv] [--output results.jsonl]
+
+Without --input the MSRP test set is scored and accuracy is printed as well.
+Input is a tab separated file with the two sentences in the last two columns.
+"""
+import os
+import argparse
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+from sklearn.externals import joblib
+
+from model import DataGenerator, features_for_prediction_batch
+from metrics import stage_metrics
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
+
+logger = logging.getLogger(__name__)
+
+
+def get_prediction(prediction, probabilities):
+    """
+    Return classifier result with unrounded probabilities of not paraphrase and paraphrase
+    """
+    return {
+        'is_paraphrase': bool(prediction == 1),
+        'probabilities': [float(probabilities[0]), float(probabilities[1])],
+    }
+
+
+def format_prediction(result):
+    """
+    result - get_prediction result
+    Return response with probabilities rounded to percent
+    """
+    return {
+        'is_paraphrase': result['is_paraphrase'],
+        'not_paraphrase_probability': int(round(result['probabilities'][0] * 100)),
+        'paraphrase_probability': int(round(result['probabilities'][1] * 100)),
+    }
+
+
+def predict_batch(model_v, pairs):
+    """
+    pairs - list of (s1, s2)
+    Return list of get_prediction results, the classifier is called once for the whole batch
+    """
+    if len(pairs) == 0:
+        return []
+
+    return predict_features(model_v, features_for_prediction_batch(pairs))
+
+
+def predict_features(model_v, features):
+    """
+    features - (n, len(PREDICTION_FEATURE_NAMES)) matrix
+    Return list of get_prediction results
+    """
+    with stage_metrics.timer('classifier'):
+        predictions = model_v.predict(features)
+        probabilities = model_v._predict_proba_lr(features)
+
+    return [
+        get_prediction(prediction, probability)
+        for prediction, probability in zip(predictions, probabilities)
+    ]
+
+
+def rank(candidates, results, top_k=None, min_probability=None):
+    """
+    candidates - list of candidate sentences, results - their get_prediction results
+    min_probability - Drop candidates with lower paraphrase probability (percent)
+    Return top_k format_prediction results by unrounded paraphrase probability with index and sentence
+    of the candidate, candidates with the same probability keep their order
+    """
+    ranked = [
+        (index, candidate, result)
+        for index, (candidate, result) in enumerate(zip(candidates, results))
+        if min_probability is None or result['probabilities'][1] * 100 >= min_probability
+    ]
+    ranked.sort(key=lambda item: -item[2]['probabilities'][1])
+    if top_k is not None:
+        ranked = ranked[:top_k]
+    return [dict(format_prediction(result), index=index, sentence=candidate) for index, candidate, result in ranked]
+
+
+# Classifier and optional cascade.Cascade of the worker process, set by init_worker
+worker_model = None
+worker_cascade = None
+
+
+def init_worker(model_path):
+    from cascade import get_cascade
+
+    global worker_model, worker_cascade
+    worker_model = joblib.load(model_path)
+    worker_cascade = get_cascade(worker_model)
+
+
+def score_chunk(pairs):
+    if worker_cascade is not None:
+        return worker_cascade.predict_batch(pairs)
+    return predict_batch(worker_model, pairs)
+
+
+class ScoringPool:
+    """
+    workers - Number of processes, all cores by default
+    chunk_size - Max pairs sent to a worker at once, small batches are split so every worker gets a share
+    """
+
+    def __init__(self, workers=None, model_path=MODEL_V, chunk_size=32):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(self.workers, initializer=init_worker, initargs=(model_path,))
+
+    def get_chunks(self, pairs):
+        chunk_size = min(self.chunk_size, max(1, -(-len(pairs) // self.workers)))
+        return [pairs[start:start + chunk_size] for start in range(0, len(pairs), chunk_size)]
+
+    def score(self, pairs):
+        """
+        pairs - list of (s1, s2)
+        Return list of get_prediction results in input order
+        """
+        results = []
+        for chunk_results in self.pool.map(score_chunk, self.get_chunks(list(pairs))):
+            results.extend(chunk_results)
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_scoring_pool():
+    """
+    Pool shared by the process, configured with SCORING_WORKERS (0 or unset - no pool)
+    Created on first use, so that it is not forked by gunicorn --preload
+    """
+    global _pool
+    workers = int(os.environ.get('SCORING_WORKERS', 0))
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ScoringPool(workers)
+        return _pool
+
+
+def read_pairs(path):
+    pairs = []
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            text = line.rstrip('\n').split('\t')
+            if len(text) >= 2:
+                pairs.append((text[-2], text[-1]))
+    return pairs
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Score sentence pairs on a process pool')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, all cores by default')
+    parser.add_argument('--input', default=None, help='Tab separated pairs, MSRP test set by default')
+    parser.add_argument('--output', default=None, help='JSON lines file with one result per pair')
+    args = parser.parse_args()
+
+    labels = None
+    if args.input:
+        pairs = read_pairs(args.input)
+    else:
+        data = DataGenerator.get_test_data()
+        pairs = [(x['s1'], x['s2']) for x in data]
+        labels = [x['label'] for x in data]
+
+    pool = ScoringPool(args.workers)
+    t = time.time()
+    results = pool.score(pairs)
+    elapsed = time.time() - t
+    pool.close()
+
+    print('%d pairs, %d workers, %.1fs, %.1f pairs/sec' % (len(pairs), pool.workers, elapsed, len(pairs) / elapsed))
+    if labels is not None:
+        correct = sum(int(r['is_paraphrase']) == label for r, label in zip(results, labels))
+        print('Accuracy: %.4f' % (correct / len(labels)))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            for result in results:
+                f.write(json.dumps(format_prediction(result)) + '\n')
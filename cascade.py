@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Cascade scoring: a first stage classifier on cheap features decides pairs it is confident about,
+only the rest is scored with model_v. The other model_v features are computed only for these pairs,
+reusing the sentence and pair analyses of the cheap features.
+
+Cheap features are the length, n-gram, edge, path n-gram and BLEU features of March
+plus root similarity and edge matchers, no Hungarian matching, GED or path/subtree vectors.
+
+    python corpus.py extract
+    python cascade.py fit [--path corpus_features.npz]
+    python cascade.py evaluate [--path corpus_features.npz]
+
+fit trains the first stage on the train rows and saves it to CASCADE_MODEL, evaluate reports
+the fraction of MSRP test pairs that exit early and the accuracy change against model_v alone
+for several thresholds. Serving uses the cascade if CASCADE_THRESHOLD is set, e.g. 0.9.
+"""
+import sys
+import os
+import argparse
+import logging
+import threading
+
+import numpy as np
+
+from sklearn.externals import joblib
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, f1_score
+
+import model
+from model import AllFeatureFinal, DataGenerator, FeatureCache, PREDICTION_FEATURE_NAMES, features_for_prediction_batch
+from bulk import get_prediction, predict_features
+from corpus import CORPUS_FEATURES, get_prediction_columns, load_features
+from metrics import stage_metrics
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
+CASCADE_MODEL = os.path.join(APP_ROOT, 'cascade_model.sav')
+
+# Generators of the first stage, none of them solves an assignment or compares path/subtree vectors
+CASCADE_GENERATORS = [
+    'RootNodeFeature',
+    'SimpleEdgeMatcher',
+    'SimpleEdgeMatcherWithDependancy',
+    'MarchFeatureGeneratorWithoutBleu',
+    'MarchFeatureGeneratorOnlyBleu',
+]
+
+CASCADE_FEATURE_NAMES = [
+    column.name for column in AllFeatureFinal().get_columns() if column.generator in CASCADE_GENERATORS
+]
+
+# Features model_v needs besides the cheap ones, computed only for pairs that do not exit early
+CASCADE_REST_FEATURE_NAMES = [name for name in PREDICTION_FEATURE_NAMES if name not in CASCADE_FEATURE_NAMES]
+
+# Columns of PREDICTION_FEATURE_NAMES in CASCADE_FEATURE_NAMES + CASCADE_REST_FEATURE_NAMES
+PREDICTION_COLUMNS = [
+    (CASCADE_FEATURE_NAMES + CASCADE_REST_FEATURE_NAMES).index(name) for name in PREDICTION_FEATURE_NAMES
+]
+
+EVALUATED_THRESHOLDS = [0.7, 0.8, 0.85, 0.9, 0.95, 0.99]
+
+logger = logging.getLogger(__name__)
+
+
+class Cascade:
+    """
+    first_stage - Classifier with predict_proba, trained on CASCADE_FEATURE_NAMES
+    threshold - Pairs with first stage probability of the predicted class at least threshold exit early
+    """
+
+    def __init__(self, first_stage, model_v, threshold=0.9):
+        self.first_stage = first_stage
+        self.model_v = model_v
+        self.threshold = threshold
+        self.pairs = 0
+        self.early_exits = 0
+        self.stats_lock = threading.Lock()
+
+    def predict_batch(self, pairs):
+        """
+        pairs - list of (s1, s2)
+        Return list of get_prediction results in input order
+        """
+        if len(pairs) == 0:
+            return []
+
+        # Pair analyses of the cheap features keep matched tokens, edges and paths for the rest
+        pair_analyses = {}
+        features = features_for_prediction_batch(pairs, CASCADE_FEATURE_NAMES, pair_analyses)
+        with stage_metrics.timer('cascade_classifier'):
+            probabilities = self.first_stage.predict_proba(features)
+        confident = probabilities.max(axis=1) >= self.threshold
+
+        results = [None] * len(pairs)
+        for index in np.where(confident)[0]:
+            prediction = self.first_stage.classes_[probabilities[index].argmax()]
+            results[index] = get_prediction(prediction, probabilities[index])
+
+        uncertain = np.where(~confident)[0]
+        if len(uncertain) > 0:
+            uncertain_pairs = [pairs[i] for i in uncertain]
+            rest = features_for_prediction_batch(uncertain_pairs, CASCADE_REST_FEATURE_NAMES, pair_analyses)
+            uncertain_features = np.hstack([features[uncertain], rest])[:, PREDICTION_COLUMNS]
+            for index, result in zip(uncertain, predict_features(self.model_v, uncertain_features)):
+                results[index] = result
+
+        # Batches of concurrent requests run on several threads
+        with self.stats_lock:
+            self.pairs += len(pairs)
+            self.early_exits += int(confident.sum())
+        return results
+
+    def get_stats(self):
+        with self.stats_lock:
+            pairs = self.pairs
+            early_exits = self.early_exits
+        return {
+            'threshold': self.threshold,
+            'pairs': pairs,
+            'early_exits': early_exits,
+            'early_exit_fraction': early_exits / pairs if pairs else 0.,
+        }
+
+    @classmethod
+    def test_confident_pairs(cls):
+        """
+        Expensive features of pairs that exit early are never computed
+        """
+
+        class ConfidentAboutFirst:
+            classes_ = np.array([0, 1])
+
+            def predict_proba(self, X):
+                probabilities = np.full((len(X), 2), 0.5)
+                probabilities[0] = [0., 1.]
+                return probabilities
+
+        pairs = [(x['s1'], x['s2']) for x in DataGenerator.get_test_data()[:3]]
+        cache = model.feature_cache
+        model.feature_cache = FeatureCache(64 * 1024 * 1024, 16 * 1024 * 1024)
+        try:
+            results = cls(ConfidentAboutFirst(), joblib.load(MODEL_V)).predict_batch(pairs)
+            computed = [(key1, key2) for key1, key2, names in model.feature_cache.pairs.items
+                        if list(names) == CASCADE_REST_FEATURE_NAMES]
+        finally:
+            model.feature_cache = cache
+
+        first = (FeatureCache.get_key(pairs[0][0]), FeatureCache.get_key(pairs[0][1]))
+        assert first not in computed
+        assert len(computed) == 2
+        assert results[0]['is_paraphrase'] and results[0]['probabilities'] == [0., 1.]
+
+
+def get_cascade_columns(data):
+    return get_prediction_columns(data, CASCADE_FEATURE_NAMES)
+
+
+def fit(data):
+    """
+    data - Corpus features from corpus.load_features
+    """
+    first_stage = LogisticRegression()
+    first_stage.fit(data['X_train'][:, get_cascade_columns(data)], data['y_train'])
+    return first_stage
+
+
+def save(first_stage, path=CASCADE_MODEL):
+    joblib.dump({'model': first_stage, 'feature_names': CASCADE_FEATURE_NAMES}, path)
+
+
+def load(path=CASCADE_MODEL):
+    saved = joblib.load(path)
+    if list(saved['feature_names']) != CASCADE_FEATURE_NAMES:
+        raise ValueError('%s was trained on other features, fit it again' % path)
+    return saved['model']
+
+
+def evaluate(data, first_stage, model_v, thresholds=EVALUATED_THRESHOLDS):
+    """
+    Return (full model_v accuracy and f1, list of results per threshold) on the test rows
+    """
+    y = data['y_test']
+    full = model_v.predict(data['X_test'][:, get_prediction_columns(data)])
+    probabilities = first_stage.predict_proba(data['X_test'][:, get_cascade_columns(data)])
+    first = first_stage.classes_[probabilities.argmax(axis=1)]
+
+    baseline = {'accuracy': accuracy_score(y, full), 'f1': f1_score(y, full)}
+    results = []
+    for threshold in thresholds:
+        confident = probabilities.max(axis=1) >= threshold
+        predictions = np.where(confident, first, full)
+        accuracy = accuracy_score(y, predictions)
+        results.append({
+            'threshold': threshold,
+            'early_exit_fraction': float(confident.mean()),
+            'accuracy': accuracy,
+            'accuracy_delta': accuracy - baseline['accuracy'],
+            'f1': f1_score(y, predictions),
+            'early_exit_accuracy': accuracy_score(y[confident], first[confident]) if confident.any() else None,
+        })
+    return baseline, results
+
+
+def get_cascade(model_v, path=CASCADE_MODEL):
+    """
+    Cascade configured with CASCADE_THRESHOLD, None if it is not set or CASCADE_MODEL does not exist
+    """
+    threshold = os.environ.get('CASCADE_THRESHOLD')
+    if threshold is None:
+        return None
+    if not os.path.exists(path):
+        logger.warning('CASCADE_THRESHOLD is set, but %s does not exist, run "python cascade.py fit"', path)
+        return None
+    return Cascade(load(path), model_v, float(threshold))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='First stage classifier of cascade scoring')
+    parser.add_argument('command', choices=['fit', 'evaluate'])
+    parser.add_argument('--path', default=CORPUS_FEATURES)
+    parser.add_argument('--model', default=CASCADE_MODEL, help='First stage classifier file')
+    args = parser.parse_args()
+
+    data = load_features(args.path)
+    if data is None:
+        print('%s does not exist, run "python corpus.py extract" first' % args.path)
+        sys.exit(1)
+
+    if args.command == 'fit':
+        save(fit(data), args.model)
+        print('Saved to %s' % args.model)
+
+    baseline, results = evaluate(data, load(args.model), joblib.load(MODEL_V))
+    print('%d cheap features, model_v alone: accuracy %.4f, f1 %.4f' % (
+        len(CASCADE_FEATURE_NAMES), baseline['accuracy'], baseline['f1']))
+    print('%9s %10s %9s %8s %7s %15s' % ('threshold', 'early exit', 'accuracy', 'delta', 'f1', 'exit accuracy'))
+    for result in results:
+        print('%9.2f %9.1f%% %9.4f %+8.4f %7.4f %15s' % (
+            result['threshold'], result['early_exit_fraction'] * 100, result['accuracy'],
+            result['accuracy_delta'], result['f1'],
+            '-' if result['early_exit_accuracy'] is None else '%.4f' % result['early_exit_accuracy'],
+        ))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed AllFeatureFinal features of the MSRP corpus.
+
+    python corpus.py extract [--workers N] [--path corpus_features.npz]
+    python corpus.py evaluate [--path corpus_features.npz] [--save finalized_model.sav]
+    python corpus.py idf
+
+extract keeps rows of an existing matrix whose sentences did not change,
+only new or changed pairs are computed (in parallel, one process per core by default).
+evaluate fits the classifier on the train rows and reports its quality on the test rows.
+idf fits TfIdf on the test set (as model.py does without the artifact) and saves it to IDF_MODEL.
+"""
+import sys
+import os
+import argparse
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from sklearn.externals import joblib
+from sklearn.svm import LinearSVC
+from sklearn.metrics import accuracy_score, f1_score
+
+from model import (
+    AllFeatureFinal, DataGenerator, FeatureCache, FEATURES_VERSION, IDF_MODEL, PREDICTION_FEATURE_NAMES, TfIdf,
+    features_for_prediction_batch,
+)
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+CORPUS_FEATURES = os.path.join(APP_ROOT, 'corpus_features.npz')
+MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
+
+SPLITS = ['train', 'test']
+
+logger = logging.getLogger(__name__)
+
+
+def get_row_key(s1, s2):
+    return FeatureCache.get_key(s1) + FeatureCache.get_key(s2)
+
+
+def get_corpus():
+    """
+    Return dict split -> list of {"s1", "s2", "label"}
+    """
+    return {
+        'train': DataGenerator.get_train_data(),
+        'test': DataGenerator.get_test_data(),
+    }
+
+
+def extract_batch(pairs):
+    """
+    Worker function, pairs - list of (s1, s2)
+    """
+    return features_for_prediction_batch(pairs, AllFeatureFinal().get_feature_names())
+
+
+def extract_features(pairs, workers=None, batch_size=20):
+    """
+    Return (len(pairs), 113) matrix, batches of pairs are spread over a process pool
+    """
+    feature_names = AllFeatureFinal().get_feature_names()
+    if len(pairs) == 0:
+        return np.zeros((0, len(feature_names)))
+
+    batches = [pairs[start:start + batch_size] for start in range(0, len(pairs), batch_size)]
+    if workers == 1:
+        results = [extract_batch(batch) for batch in batches]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = []
+            for batch_features in pool.imap(extract_batch, batches):
+                results.append(batch_features)
+                logger.info('Extracted %d / %d pairs', sum(len(r) for r in results), len(pairs))
+
+    return np.vstack(results)
+
+
+def load_features(path=CORPUS_FEATURES):
+    """
+    Return dict with X_<split>, y_<split>, keys_<split>, feature_names, features_version
+    or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def build_features(path=CORPUS_FEATURES, workers=None):
+    """
+    Extract features of the whole corpus into path, rows of the previous matrix are reused
+    if their sentences, feature names and FEATURES_VERSION did not change
+    """
+    feature_names = AllFeatureFinal().get_feature_names()
+    previous = load_features(path)
+    if previous is not None and (
+            int(previous['features_version']) != FEATURES_VERSION or
+            list(previous['feature_names']) != feature_names):
+        logger.info('Feature version changed, all rows are recomputed')
+        previous = None
+
+    result = {
+        'feature_names': np.array(feature_names),
+        'features_version': np.array(FEATURES_VERSION),
+    }
+    for split, data in get_corpus().items():
+        keys = [get_row_key(x['s1'], x['s2']) for x in data]
+        X = np.zeros((len(data), len(feature_names)))
+
+        known = {}
+        if previous is not None:
+            known = {key: index for index, key in enumerate(previous['keys_' + split])}
+        missing = [index for index, key in enumerate(keys) if key not in known]
+        for index, key in enumerate(keys):
+            if key in known:
+                X[index] = previous['X_' + split][known[key]]
+
+        logger.info('%s: %d rows, %d to compute', split, len(data), len(missing))
+        t = time.time()
+        X[missing] = extract_features([(data[i]['s1'], data[i]['s2']) for i in missing], workers)
+        logger.info('%s: computed in %.1fs', split, time.time() - t)
+
+        result['X_' + split] = X
+        result['y_' + split] = np.array([x['label'] for x in data])
+        result['keys_' + split] = np.array(keys)
+
+    np.savez_compressed(path, **result)
+    return result
+
+
+def get_prediction_columns(data, feature_names=None):
+    """
+    Return indexes of columns the classifier uses
+    """
+    if feature_names is None:
+        feature_names = PREDICTION_FEATURE_NAMES
+    all_names = list(data['feature_names'])
+    return [all_names.index(name) for name in feature_names]
+
+
+def evaluate(data, model):
+    columns = get_prediction_columns(data)
+    y_pred = model.predict(data['X_test'][:, columns])
+    return {
+        'accuracy': accuracy_score(data['y_test'], y_pred),
+        'f1': f1_score(data['y_test'], y_pred),
+    }
+
+
+def fit(data):
+    columns = get_prediction_columns(data)
+    model = LinearSVC()
+    model.fit(data['X_train'][:, columns], data['y_train'])
+    return model
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='MSRP corpus feature matrix')
+    parser.add_argument('command', choices=['extract', 'evaluate', 'idf'])
+    parser.add_argument('--path', default=CORPUS_FEATURES)
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, all cores by default')
+    parser.add_argument('--save', default=None, help='Save the fitted classifier to this file')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        build_features(args.path, args.workers)
+        sys.exit(0)
+
+    if args.command == 'idf':
+        TfIdf(DataGenerator.get_test_data()).save(IDF_MODEL)
+        print('Saved to %s' % IDF_MODEL)
+        sys.exit(0)
+
+    data = load_features(args.path)
+    if data is None:
+        print('%s does not exist, run "python corpus.py extract" first' % args.path)
+        sys.exit(1)
+
+    model = fit(data)
+    print('Fitted model: %s' % evaluate(data, model))
+    if os.path.exists(MODEL_V):
+        print('Current %s: %s' % (os.path.basename(MODEL_V), evaluate(data, joblib.load(MODEL_V))))
+    if args.save:
+        joblib.dump(model, args.save)
+        print('Saved to %s' % args.save)
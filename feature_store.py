@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent feature store shared by all gunicorn workers of a dyno.
+
+Pair feature vectors are kept in a SQLite file (WAL mode, so readers in one worker
+do not block the writer in another). Every row carries the version key of the model
+and of the feature code it was computed with, rows of other versions are never served.
+
+Warm start from the MSRP dataset:
+    FEATURE_STORE_PATH=features.sqlite python feature_store.py warm
+"""
+import sys
+import os
+import hashlib
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
+
+logger = logging.getLogger(__name__)
+
+
+def update_hash(h, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+
+
+def get_version(model_path, features_version, feature_names, idf_path, spacy_model):
+    """
+    Version key of stored features: hash of the model file, the feature code version, feature names,
+    the files of the IDF tables directory (TfIdf is fitted at startup if it does not exist) and spaCy model
+    spacy_model - Name and version from nlp.meta, the features depend on its vectors and parses
+    """
+    h = hashlib.sha1()
+    update_hash(h, model_path)
+    h.update(str(features_version).encode('utf8'))
+    h.update(','.join(feature_names).encode('utf8'))
+    if os.path.isdir(idf_path):
+        for name in sorted(os.listdir(idf_path)):
+            h.update(name.encode('utf8'))
+            update_hash(h, os.path.join(idf_path, name))
+    h.update(spacy_model.encode('utf8'))
+    return h.hexdigest()
+
+
+class FeatureStore:
+    """
+    path - SQLite file, created if missing
+    version - Version key from get_version, only rows with this key are read
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS features (
+            pair_key TEXT NOT NULL,
+            version TEXT NOT NULL,
+            features BLOB NOT NULL,
+            PRIMARY KEY (pair_key, version)
+        )
+    """
+
+    def __init__(self, path, version, timeout=5.0):
+        self.path = path
+        self.version = version
+        self.timeout = timeout
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.get_connection()
+
+    def get_connection(self):
+        """
+        One connection per thread and process, connections opened before fork (gunicorn --preload) are not reused
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(self.SCHEMA)
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    @classmethod
+    def get_key(cls, key1, key2, feature_names):
+        """
+        key1, key2 - Content hashes of the sentences (FeatureCache.get_key)
+        """
+        return hashlib.sha1(
+            ('%s:%s:%s' % (key1, key2, ','.join(feature_names))).encode('utf8')
+        ).hexdigest()
+
+    def get(self, pair_key):
+        """
+        Return stored features or None, errors (locked or broken file) are treated as misses
+        """
+        try:
+            row = self.get_connection().execute(
+                'SELECT features FROM features WHERE pair_key = ? AND version = ?',
+                (pair_key, self.version)
+            ).fetchone()
+        except sqlite3.Error as e:
+            with self.lock:
+                self.errors += 1
+            logger.warning('Feature store read failed: %s', e)
+            return None
+
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float64).copy()
+
+    def contains(self, pair_keys):
+        """
+        Return set of pair_keys already stored for this version
+        """
+        found = set()
+        connection = self.get_connection()
+        pair_keys = list(pair_keys)
+        for start in range(0, len(pair_keys), 500):
+            chunk = pair_keys[start:start + 500]
+            rows = connection.execute(
+                'SELECT pair_key FROM features WHERE version = ? AND pair_key IN (%s)' % ','.join('?' * len(chunk)),
+                [self.version] + chunk
+            ).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def put(self, pair_key, features):
+        self.put_many([(pair_key, features)])
+
+    def put_many(self, items):
+        """
+        items - list of (pair_key, features), written in one transaction
+        """
+        rows = [
+            (pair_key, self.version, sqlite3.Binary(np.asarray(features, dtype=np.float64).tobytes()))
+            for pair_key, features in items
+        ]
+        try:
+            with self.get_connection() as connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT OR REPLACE INTO features (pair_key, version, features) VALUES (?, ?, ?)',
+                    rows
+                )
+        except sqlite3.Error as e:
+            with self.lock:
+                self.errors += 1
+            logger.warning('Feature store write failed: %s', e)
+
+    def remove_stale(self):
+        """
+        Delete rows of other versions, return number of deleted rows
+        """
+        with self.get_connection() as connection:
+            connection.execute('BEGIN')
+            deleted = connection.execute('DELETE FROM features WHERE version != ?', (self.version,)).rowcount
+        return deleted
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'path': self.path,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+            }
+
+
+def get_feature_store(model_path=MODEL_V):
+    """
+    Store configured with FEATURE_STORE_PATH, None if it is not set
+    """
+    path = os.environ.get('FEATURE_STORE_PATH')
+    if not path:
+        return None
+
+    from model import FEATURES_VERSION, IDF_MODEL, PREDICTION_FEATURE_NAMES, nlp
+    spacy_model = '%s-%s' % (nlp.meta.get('name'), nlp.meta.get('version'))
+    return FeatureStore(path, get_version(
+        model_path, FEATURES_VERSION, PREDICTION_FEATURE_NAMES, IDF_MODEL, spacy_model
+    ))
+
+
+def warm_start(store, batch_size=100):
+    """
+    Compute and store features of all MSRP train and test pairs missing in the store
+    """
+    from model import DataGenerator, PREDICTION_FEATURE_NAMES, feature_cache, features_for_prediction_batch
+
+    data = DataGenerator.get_train_data() + DataGenerator.get_test_data()
+    pairs = list(dict.fromkeys((x['s1'], x['s2']) for x in data))
+
+    def get_pair_key(pair):
+        return store.get_key(feature_cache.get_key(pair[0]), feature_cache.get_key(pair[1]), PREDICTION_FEATURE_NAMES)
+
+    stored = store.contains(get_pair_key(pair) for pair in pairs)
+    missing = [pair for pair in pairs if get_pair_key(pair) not in stored]
+    logger.info('Feature store warm start: %d pairs, %d missing', len(pairs), len(missing))
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        features = features_for_prediction_batch(batch)
+        store.put_many([(get_pair_key(pair), f) for pair, f in zip(batch, features)])
+        logger.info('Feature store warm start: %d / %d', start + len(batch), len(missing))
+
+    return len(missing)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('warm', 'stats'):
+        print('Usage: FEATURE_STORE_PATH=<file> python feature_store.py warm|stats')
+        sys.exit(1)
+
+    store = get_feature_store()
+    if store is None:
+        print('FEATURE_STORE_PATH is not set')
+        sys.exit(1)
+
+    if sys.argv[1] == 'warm':
+        logger.info('Removed %d stale rows', store.remove_stale())
+        warm_start(store)
+    else:
+        print(store.get_stats())
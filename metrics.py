@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms of request stages (spaCy parse, feature generators, GED, classifier)
+rendered in Prometheus text format.
+
+Observing is a perf_counter difference, a bisect and a locked increment, cheap enough to stay on.
+Set METRICS_ENABLED=0 to turn it off.
+"""
+import os
+import bisect
+import threading
+import time
+
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Last item counts values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def get_snapshot(self):
+        """
+        Return (cumulative counts per bucket including +Inf, sum, count)
+        """
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageMetrics:
+    """
+    Histogram per stage name plus optional extra metrics sources, see add_source
+    """
+
+    def __init__(self, name, help_text, enabled=True):
+        self.name = name
+        self.help_text = help_text
+        self.enabled = enabled
+        self.histograms = {}
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def get_histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.get_histogram(stage).observe(seconds)
+
+    def timer(self, stage):
+        """
+        with stage_metrics.timer('classifier'): ...
+        """
+        return Timer(self, stage)
+
+    def add_source(self, get_metrics):
+        """
+        get_metrics - Function that returns list of (name, type, help, value), e.g. queue depth gauges
+        """
+        self.sources.append(get_metrics)
+
+    @classmethod
+    def format_value(cls, value):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(float(value))
+
+    def render(self):
+        """
+        Return all metrics in Prometheus text exposition format
+        """
+        lines = [
+            '# HELP %s %s' % (self.name, self.help_text),
+            '# TYPE %s histogram' % self.name,
+        ]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for stage, histogram in histograms:
+            cumulative, total, count = histogram.get_snapshot()
+            for bound, c in zip(list(histogram.buckets) + [float('inf')], cumulative):
+                lines.append('%s_bucket{stage="%s",le="%s"} %d' % (self.name, stage, self.format_value(bound), c))
+            lines.append('%s_sum{stage="%s"} %s' % (self.name, stage, self.format_value(total)))
+            lines.append('%s_count{stage="%s"} %d' % (self.name, stage, count))
+
+        for get_metrics in self.sources:
+            for name, metric_type, help_text, value in get_metrics():
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                lines.append('%s %s' % (name, self.format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+stage_metrics = StageMetrics(
+    'paraphrase_stage_seconds',
+    'Latency of request stages in seconds',
+    enabled=os.environ.get('METRICS_ENABLED', '1') != '0',
+)
@@ -1,5 +1,13 @@
 # All imports and installs should be here
 import sys
+import os
+import hashlib
+import json
+import threading
+import time
+import logging
+import unicodedata
+from collections import OrderedDict
 
 import pandas as pd
 import numpy as np
@@ -19,12 +27,29 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 
 from spacy.tokens import Token as SpacyToken
 
+from metrics import stage_metrics
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Precomputed TfIdf tables (directory, see TfIdf.save), built with "python corpus.py idf"
+IDF_MODEL = os.path.join(APP_ROOT, 'idf_model')
+
+# Pipeline components no feature uses
+SPACY_DISABLE = ['ner']
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent loading each heavy object at import, reported by app.py
+startup_times = OrderedDict()
+
 
 class TfIdf:
-    def __init__(self, data):
+    def __init__(self, data=None):
         self.data = data
-        self.prepare_corpus()
-        self.fit()
+        if data is not None:
+            self.prepare_corpus()
+            self.fit()
 
     def prepare_corpus(self):
         self.corpus = [x['s1'] for x in self.data] + [x['s2'] for x in self.data]
@@ -42,12 +67,39 @@ class TfIdf:
 
         self.vectorizer = vectorizer
 
-        self.words_list = vectorizer.get_feature_names()
-        self.idf = vectorizer._tfidf.idf_
+        self.build_index(vectorizer.get_feature_names(), vectorizer._tfidf.idf_)
 
-        self.word_to_index = {}
-        for index, w in enumerate(self.words_list):
-            self.word_to_index[w] = index
+    def build_index(self, words, idf):
+        """
+        Vocabulary as sorted array of utf8 bytes (searchsorted lookups) with float32 idf in the same order.
+        float32 is enough: idf only scales float32 token vectors, numpy casts float64 scalar to float32 there anyway.
+        """
+        vocab = np.array([w.encode('utf8') for w in words], dtype=bytes)
+        order = np.argsort(vocab, kind='stable')
+        self.vocab = vocab[order]
+        self.idf = np.asarray(idf, dtype=np.float32)[order]
+        # https://github.com/scikit-learn/scikit-learn/blob/0fb307bf3/sklearn/feature_extraction/text.py#L1443
+        self.default_idf = np.float32(np.log(self.corpus_len + 1 / 1) + 1)
+
+    def save(self, path):
+        """
+        path - Directory with vocab.npy, idf.npy and meta.json, the arrays can be memory mapped
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vocab.npy'), self.vocab)
+        np.save(os.path.join(path, 'idf.npy'), self.idf)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'corpus_len': self.corpus_len}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        tf_idf = cls()
+        with open(os.path.join(path, 'meta.json')) as f:
+            tf_idf.corpus_len = json.load(f)['corpus_len']
+        tf_idf.vocab = np.load(os.path.join(path, 'vocab.npy'), mmap_mode=mmap_mode)
+        tf_idf.idf = np.load(os.path.join(path, 'idf.npy'), mmap_mode=mmap_mode)
+        tf_idf.default_idf = np.float32(np.log(tf_idf.corpus_len + 1 / 1) + 1)
+        return tf_idf
 
     def use_idf(self, t):
         return (t.is_alpha and
@@ -60,13 +112,27 @@ class TfIdf:
         return self.get_word_idf(token.text)
 
     def get_word_idf(self, word):
-        if word in self.word_to_index:
-            idf = self.idf[self.word_to_index[word]]
-        else:
-            # https://github.com/scikit-learn/scikit-learn/blob/0fb307bf3/sklearn/feature_extraction/text.py#L1443
-            idf = np.log(self.corpus_len + 1 / 1) + 1
-        #         print("Calling idf for " + word + " = " + str(idf))
-        return idf
+        return self.get_words_idf([word])[0]
+
+    def get_words_idf(self, words):
+        """
+        Return float32 array with idf of every word, words out of vocabulary get idf of unseen word
+        """
+        if len(words) == 0 or len(self.vocab) == 0:
+            return np.full(len(words), self.default_idf, dtype=np.float32)
+        words = np.array([w.encode('utf8') for w in words], dtype=bytes)
+        index = np.minimum(np.searchsorted(self.vocab, words), len(self.vocab) - 1)
+        return np.where(self.vocab[index] == words, self.idf[index], self.default_idf).astype(np.float32)
+
+    def get_tokens_weights(self, tokens):
+        """
+        Vectorized get_idf: float32 array with idf of tokens use_idf accepts and 1 for others (and None)
+        """
+        mask = np.array([t is not None and self.use_idf(t) for t in tokens], dtype=bool)
+        weights = np.ones(len(tokens), dtype=np.float32)
+        if mask.any():
+            weights[mask] = self.get_words_idf([t.text for t, m in zip(tokens, mask) if m])
+        return weights
 
 
 def get_data_location():
@@ -134,21 +200,42 @@ class DataGenerator:
         ]
 
 
-idf_model = TfIdf(DataGenerator.get_test_data())
+def get_idf_model():
+    """
+    Load precomputed tables if present, otherwise fit on the test set
+    """
+    if os.path.exists(os.path.join(IDF_MODEL, 'meta.json')):
+        return TfIdf.load(IDF_MODEL)
+    logger.warning('%s not found, fitting TfIdf on the test set', IDF_MODEL)
+    return TfIdf(DataGenerator.get_test_data())
 
 
 def get_spacy_module():
-    return spacy.load('en_core_web_sm')
+    return spacy.load('en_core_web_sm', disable=SPACY_DISABLE)
     # return en_core_web_md.load()
 
 
-nlp = get_spacy_module()
+def timed(name, load):
+    t = time.time()
+    value = load()
+    startup_times[name] = time.time() - t
+    logger.info('Loaded %s in %.3fs', name, startup_times[name])
+    return value
+
+
+idf_model = timed('idf_model', get_idf_model)
+
+nlp = timed('nlp', get_spacy_module)
 
 
 def get_dependancy_graph(s, display=False):
     doc = nlp(s)
     if display:
         spacy.displacy.render(doc, style="dep", jupyter=True)
+    return build_dependancy_graph(doc)
+
+
+def build_dependancy_graph(doc):
     edges = []
     nodes = [{
         "node": "ROOT",
@@ -180,13 +267,329 @@ def get_dependancy_graph(s, display=False):
     return {"nodes": nodes, "edges": edges}
 
 
+# Longest path and deepest subtree used by features
+MAX_PATH_LENGTH = 4
+
+
+class DependancyTree:
+    """
+    Dependancy parse as arrays, node 0 is fake ROOT and node i + 1 is token i (as in build_dependancy_graph):
+    parent - parent node, -1 for ROOT
+    children_indptr, children - CSR lists of children, in token order
+    depth - distance from ROOT
+    dep - dependancy label ids (spaCy hashes of token.dep_), 0 for ROOT
+    """
+
+    def __init__(self, parent, dep):
+        self.parent = parent
+        self.dep = dep
+        self.size = len(parent)
+
+        self.children = np.argsort(parent[1:], kind='stable') + 1
+        self.children_indptr = np.zeros(self.size + 1, dtype=int)
+        np.cumsum(np.bincount(parent[1:], minlength=self.size), out=self.children_indptr[1:])
+
+        self.build_depth()
+
+    @classmethod
+    def from_doc(cls, doc):
+        parent = np.array(
+            [-1] + [0 if token.dep_ == "ROOT" else token.head.i + 1 for token in doc],
+            dtype=int
+        )
+        dep = np.array([0] + [token.dep for token in doc], dtype=np.uint64)
+        return cls(parent, dep)
+
+    def get_children(self, node):
+        return self.children[self.children_indptr[node]:self.children_indptr[node + 1]]
+
+    def build_depth(self):
+        """
+        depth and height (longest distance to a descendant), -1 for nodes not reachable from ROOT
+        """
+        self.depth = np.full(self.size, -1, dtype=int)
+        self.height = np.full(self.size, -1, dtype=int)
+        levels = []
+        frontier = np.array([0])
+        while len(frontier) > 0:
+            self.depth[frontier] = len(levels)
+            levels.append(frontier)
+            frontier = np.concatenate([self.get_children(node) for node in frontier])
+
+        for level in reversed(levels):
+            self.height[level] = np.maximum(self.height[level], 0)
+            np.maximum.at(self.height, self.parent[level[level != 0]], self.height[level[level != 0]] + 1)
+
+    def get_subtree(self, root, length):
+        """
+        Return nodes up to length below root, in GraphTraversal.get_all_subtrees_with_depth order
+        """
+        res, stack = [], [(root, 0)]
+        while stack:
+            node, distance = stack.pop()
+            res.append(node)
+            if distance >= length:
+                continue
+            stack.extend((child, distance + 1) for child in self.get_children(node))
+        return np.array(res, dtype=int)
+
+    def get_subtrees(self, length):
+        """
+        Return list of node index arrays, one per subtree with depth length
+        (GraphTraversal.get_all_subtrees_with_depth), ordered by root node
+        """
+        return [self.get_subtree(root, length) for root in np.nonzero(self.height >= length)[0]]
+
+    def get_path_sums(self, vectors, has_vector, max_length):
+        """
+        Return list of matrices for lengths 0..max_length, one row per downward path whose nodes all have vector
+        (rows in get_paths order): sum of node vectors, top to bottom as in GraphFeatures.get_path_features.
+        Sum of a path of length k ending at a node is the sum of length k - 1 ending at its parent plus the node.
+        """
+        parent = np.maximum(self.parent, 0)
+        sums = vectors
+        valid = has_vector & (self.depth >= 0)
+        aggregates = [sums[valid]]
+        for length in range(1, max_length + 1):
+            sums = sums[parent] + vectors
+            valid = valid[parent] & has_vector & (self.depth >= length)
+            aggregates.append(sums[valid])
+        return aggregates
+
+    def get_subtree_sums(self, vectors, has_vector, max_length):
+        """
+        Return list of matrices for lengths 0..max_length, one row per subtree whose nodes all have vector
+        (rows in get_subtrees order): sum of node vectors of the subtree.
+        Sum of a subtree of depth k is the node plus sums of depth k - 1 of its children.
+        """
+        children_parent = self.parent[1:]
+        missing = (~has_vector).astype(int)
+        sums, counts = vectors, missing
+        aggregates = [sums[(self.height >= 0) & (counts == 0)]]
+        for length in range(1, max_length + 1):
+            next_sums, next_counts = vectors.copy(), missing.copy()
+            np.add.at(next_sums, children_parent, sums[1:])
+            np.add.at(next_counts, children_parent, counts[1:])
+            sums, counts = next_sums, next_counts
+            aggregates.append(sums[(self.height >= length) & (counts == 0)])
+        return aggregates
+
+    def get_edges(self):
+        """
+        Return (start, end, dep) arrays, one item per edge, in the order and orientation of
+        networkx Graph.edges of GraphBuilder.build_nx_graph_from_dt: start is the smaller node index
+        """
+        child = np.arange(1, self.size)
+        parent = self.parent[1:]
+        start = np.minimum(parent, child)
+        order = np.lexsort((child, start))
+        return start[order], np.maximum(parent, child)[order], self.dep[1:][order]
+
+
+class SentenceAnalysis:
+    """
+    Analysis of one sentence shared by all feature generators of a request.
+
+    spaCy runs exactly once per sentence, every other artifact
+    (dependency graph, networkx graph, n-grams, ...) is derived from
+    that parse on first use and memoized.
+    """
+
+    # Number of spaCy parses done so far, see AllFeatureFinal.test_parse_once
+    parse_count = 0
+
+    def __init__(self, s, doc=None):
+        self.s = s
+        if doc is None:
+            with stage_metrics.timer('spacy_parse'):
+                doc = nlp(s)
+            SentenceAnalysis.parse_count += 1
+        self.doc = doc
+        self.memo = {}
+
+    @classmethod
+    def of(cls, s):
+        """
+        s - sentance or SentenceAnalysis
+        Return SentenceAnalysis
+        """
+        if isinstance(s, SentenceAnalysis):
+            return s
+        return cls(s)
+
+    @classmethod
+    def analyse_sentences(cls, sentences):
+        """
+        Parse all distinct sentences with one nlp.pipe batch.
+        Return dict sentance -> SentenceAnalysis
+        """
+        sentences = list(dict.fromkeys(sentences))
+        with stage_metrics.timer('spacy_parse_batch'):
+            docs = list(nlp.pipe(sentences))
+        SentenceAnalysis.parse_count += len(sentences)
+
+        return {s: cls(s, doc) for s, doc in zip(sentences, docs)}
+
+    def memoize(self, key, compute):
+        if key not in self.memo:
+            self.memo[key] = compute()
+        return self.memo[key]
+
+    def get_doc(self):
+        return self.doc
+
+    def get_len(self):
+        return np.array([len(self.doc)])
+
+    def get_n_grams(self, n):
+        return self.memoize(('n_grams', n), lambda: GeneralFeatures.get_n_grams(self.s, n, self.doc))
+
+    def get_dependancy_graph(self):
+        return self.memoize('dependancy_graph', lambda: build_dependancy_graph(self.doc))
+
+    def get_dependancy_tree(self):
+        return self.memoize('dependancy_tree', lambda: DependancyTree.from_doc(self.doc))
+
+    def get_token_vectors(self):
+        """
+        Return (vectors, has_vector): contiguous float32 matrix with row per node of dependancy graph
+        (row 0 is fake ROOT with zero vector) and boolean mask of nodes whose token has vector.
+        Token vectors are copied out of spaCy only here, nodes refer to rows by index.
+        """
+
+        def build():
+            token_vectors = [token.vector for token in self.doc]
+            dim = len(token_vectors[0]) if len(token_vectors) > 0 else 0
+            vectors = np.zeros((len(self.doc) + 1, dim), dtype=np.float32)
+            if len(token_vectors) > 0:
+                vectors[1:] = token_vectors
+            has_vector = np.array([False] + [token.has_vector for token in self.doc])
+            return vectors, has_vector
+
+        return self.memoize('token_vectors', build)
+
+    def get_path_features(self, length):
+        """
+        GraphFeatures.get_path_features: sum of node vectors of every path where all nodes have vector
+        """
+        return self.get_path_aggregates(max(length, MAX_PATH_LENGTH))[length]
+
+    def get_path_aggregates(self, max_length=None):
+        """
+        Path features of all lengths 0..max_length computed in one pass, see DependancyTree.get_path_sums
+        """
+        if max_length is None:
+            max_length = MAX_PATH_LENGTH
+        return self.memoize(('path_aggregates', max_length), lambda: self.get_dependancy_tree().get_path_sums(
+            *self.get_token_vectors(), max_length
+        ))
+
+    def get_subtree_features(self, length, idf_model=None):
+        """
+        GraphFeatures.get_subtree_features: sum of (idf weighted) node vectors
+        of every subtree where all nodes have vector
+        """
+        return self.get_subtree_aggregates(max(length, MAX_PATH_LENGTH), idf_model)[length]
+
+    def get_subtree_aggregates(self, max_length=None, idf_model=None):
+        """
+        Subtree features of all depths 0..max_length computed in one pass, see DependancyTree.get_subtree_sums
+        """
+        if max_length is None:
+            max_length = MAX_PATH_LENGTH
+
+        def build():
+            vectors, has_vector = self.get_token_vectors()
+            weighted = vectors * self.get_node_weights(idf_model)[:, None]
+            return self.get_dependancy_tree().get_subtree_sums(weighted, has_vector, max_length)
+
+        return self.memoize(('subtree_aggregates', max_length, idf_model), build)
+
+    def get_node_weights(self, idf_model=None):
+        """
+        idf of every node token looked up for the whole sentence at once, 1 for fake ROOT or without idf_model
+        """
+
+        def build():
+            if idf_model is None:
+                return np.ones(len(self.doc) + 1, dtype=np.float32)
+            return idf_model.get_tokens_weights([None] + list(self.doc))
+
+        return self.memoize(('node_weights', idf_model), build)
+
+    def get_path_vectors(self, length):
+        return self.memoize(('path_vectors', length), lambda: VectorMatrix(self.get_path_features(length)))
+
+    def get_subtree_vectors(self, length, idf_model=None):
+        return self.memoize(
+            ('subtree_vectors', length, idf_model),
+            lambda: VectorMatrix(self.get_subtree_features(length, idf_model=idf_model))
+        )
+
+    def get_node_vectors(self):
+        """
+        VectorMatrix with row per node of dependancy graph, fake ROOT node has zero vector
+        """
+
+        return self.memoize('node_vectors', lambda: VectorMatrix(self.get_token_vectors()[0]))
+
+    def get_node_has_vector(self):
+        return self.get_token_vectors()[1]
+
+    def get_root_node_index(self):
+        """
+        Node of the first ROOT token, see GraphBuilder.get_root_node
+        """
+        return self.memoize('root_node_index', lambda: self.get_dependancy_tree().get_children(0)[0])
+
+    def get_node_is_fake(self):
+        return self.memoize('node_is_fake', lambda: np.array([
+            node["is_fake"]
+            for node in self.get_dependancy_graph()["nodes"]
+        ]))
+
+    def get_node_texts(self):
+        return self.memoize('node_texts', lambda: np.array([
+            node["node"]
+            for node in self.get_dependancy_graph()["nodes"]
+        ]))
+
+    def get_edges(self):
+        """
+        Simple edge features as arrays: start node indexes, end node indexes, dependancy type ids
+        """
+        return self.memoize('edges', lambda: self.get_dependancy_tree().get_edges())
+
+    # Rough size of spaCy token with its dependancy graph and networkx nodes, in bytes
+    TOKEN_SIZE = 4096
+
+    def get_size(self):
+        """
+        Approximate memory used by the analysis and its memoized artifacts, in bytes
+        """
+
+        def get_value_size(value):
+            if isinstance(value, np.ndarray):
+                return value.nbytes
+            if isinstance(value, VectorMatrix):
+                return value.matrix.nbytes + value.norms.nbytes
+            if isinstance(value, (list, tuple)):
+                return sum(get_value_size(item) for item in value)
+            return 0
+
+        return (len(self.doc) + 1) * self.TOKEN_SIZE + sum(get_value_size(value) for value in list(self.memo.values()))
+
+
 class HungarianGraphNodesMatcher:
 
-    def __init__(self, _g1, _g2, threshold=0.5):
+    def __init__(self, _g1, _g2, threshold=0.5, matrix=None):
+        """
+        matrix - If present, precomputed node similarity matrix (see PairAnalysis.get_hungarian_similarity)
+        """
         self.g1 = _g1
         self.g2 = _g2
         self.node_threshold = threshold
-        self.create_cost_matrix()
+        self.create_cost_matrix(matrix)
         self.solve_linear_sum_assignment()
         self.match_nodes()
 
@@ -194,17 +597,20 @@ class HungarianGraphNodesMatcher:
         self.node_threshold = threshold
         self.match_nodes()
 
-    def create_cost_matrix(self):
-        self.matrix = np.zeros((len(self.g1["nodes"]), len(self.g2["nodes"])))
-        for i1, n1 in enumerate(self.g1["nodes"]):
-            for i2, n2 in enumerate(self.g2["nodes"]):
-                if (not n1["is_fake"] and not n2["is_fake"] and
-                        n1["token"].has_vector and n2["token"].has_vector):
-                    self.matrix[i1][i2] = n1["token"].similarity(n2["token"])
-                elif n1["is_fake"] == n2["is_fake"]:
-                    self.matrix[i1][i2] = n1["node"] == n2["node"]
-                else:
-                    self.matrix[i1][i2] = 0
+    def create_cost_matrix(self, matrix=None):
+        if matrix is not None:
+            self.matrix = matrix
+        else:
+            self.matrix = np.zeros((len(self.g1["nodes"]), len(self.g2["nodes"])))
+            for i1, n1 in enumerate(self.g1["nodes"]):
+                for i2, n2 in enumerate(self.g2["nodes"]):
+                    if (not n1["is_fake"] and not n2["is_fake"] and
+                            n1["token"].has_vector and n2["token"].has_vector):
+                        self.matrix[i1][i2] = n1["token"].similarity(n2["token"])
+                    elif n1["is_fake"] == n2["is_fake"]:
+                        self.matrix[i1][i2] = n1["node"] == n2["node"]
+                    else:
+                        self.matrix[i1][i2] = 0
 
         # Now we need to fleep scores, because Hungarian is trying to minimize
         self.cost = np.subtract(np.full(self.matrix.shape, 1), self.matrix)
@@ -231,29 +637,58 @@ class HungarianGraphNodesMatcher:
             if self.matrix[item[0]][item[1]] > self.node_threshold
         }
 
+    def get_matched_similarities(self):
+        """
+        Similarity of every pair of nodes assigned by Hungarian algorithm
+        """
+        return self.matrix[self.row_ind, self.col_ind]
+
+    def count_matched_nodes(self, thresholds):
+        """
+        Return array with number of matched nodes for every threshold, computed in one pass
+        """
+        return MatchFeatureVectors.count_above_thresholds(self.get_matched_similarities(), thresholds)
+
+    def get_converted_graphs_for_thresholds(self, thresholds):
+        """
+        Return dict threshold -> (g1, g2, graph1_to_graph2).
+        Thresholds which match the same nodes share the same graphs, so they are built only once.
+        """
+        converted_graphs = {}
+        graphs_by_matching = {}
+        for threshold in thresholds:
+            self.set_threshold(threshold)
+            matching = tuple(sorted(self.graph1_to_graph2.items()))
+            if matching not in graphs_by_matching:
+                g1, g2 = self.get_converted_graphs()
+                graphs_by_matching[matching] = (g1, g2, self.graph1_to_graph2)
+            converted_graphs[threshold] = graphs_by_matching[matching]
+
+        return converted_graphs
+
     def create_node_aliases(self):
-        for id1, n1 in enumerate(self.g1["nodes"]):
-            n1["alias"] = "G1_" + str(id1) + n1["node"]
-        for id2, n2 in enumerate(self.g2["nodes"]):
-            n2["alias"] = "G2_" + str(id2) + n2["node"]
+        """
+        Aliases are kept in the matcher, dependancy graphs are shared
+        between pairs (see FeatureCache) and are not modified.
+        """
+        self.aliases1 = ["G1_" + str(id1) + n1["node"] for id1, n1 in enumerate(self.g1["nodes"])]
+        self.aliases2 = ["G2_" + str(id2) + n2["node"] for id2, n2 in enumerate(self.g2["nodes"])]
         for id1, id2 in self.graph1_to_graph2.items():
             n1 = self.g1["nodes"][id1]
             n2 = self.g2["nodes"][id2]
-            n1["alias"] = "G1_" + str(id1) + "_" + n1["node"] + "_G2_" + str(id2) + "_" + n2["node"]
-            n2["alias"] = n1["alias"]
+            self.aliases1[id1] = "G1_" + str(id1) + "_" + n1["node"] + "_G2_" + str(id2) + "_" + n2["node"]
+            self.aliases2[id2] = self.aliases1[id1]
 
-    def build_graph(self, g):
+    def build_graph(self, g, aliases):
         nx_g = nx.Graph()
         for edge in g["edges"]:
-            start_node = g["nodes"][edge["start_node_id"]]
-            end_node = g["nodes"][edge["end_node_id"]]
-            nx_g.add_edge(start_node["alias"], end_node["alias"])
+            nx_g.add_edge(aliases[edge["start_node_id"]], aliases[edge["end_node_id"]])
         return nx_g
 
     def get_converted_graphs(self):
         self.create_node_aliases()
-        g1 = self.build_graph(self.g1)
-        g2 = self.build_graph(self.g2)
+        g1 = self.build_graph(self.g1, self.aliases1)
+        g2 = self.build_graph(self.g2, self.aliases2)
         return g1, g2
 
     def print_matched_nodes(self):
@@ -262,259 +697,408 @@ class HungarianGraphNodesMatcher:
             print(f"{self.g1['nodes'][id1]['node']}    =>   {self.g2['nodes'][id2]['node']}")
 
 
-class HungarianGraphFeatureGenerator:
-    NAME = 'HungarianGraph'
+SIMILARITY_THRESHOLDS = [0.8, 0.85, 0.90, 0.95]
 
-    def get_features_for_graphs(self, node_matcher, similarity):
-        node_matcher.set_threshold(similarity)
-        g1, g2 = node_matcher.get_converted_graphs()
-        score_normalized = compare_graphs(g1, g2, False, True)
-        score_raw = compare_graphs(g1, g2, False, False)
-        return np.array([score_normalized, score_raw])
 
-    def get_features(self, s1, s2):
-        g1 = get_dependancy_graph(s1, False)
-        g2 = get_dependancy_graph(s2, False)
-        node_matcher = HungarianGraphNodesMatcher(g1, g2, 0.9)
+class PairAnalysis:
+    """
+    Two SentenceAnalysis of a pair plus memo for sub-computations
+    that are shared by several feature columns (node matching, converted graphs, ...).
+    """
 
-        features = np.array([])
+    def __init__(self, s1, s2):
+        self.s1 = SentenceAnalysis.of(s1)
+        self.s2 = SentenceAnalysis.of(s2)
+        self.memo = {}
 
-        for similarity in [0.8, 0.85, 0.90, 0.95]:
-            features = np.append(features, self.get_features_for_graphs(node_matcher, similarity))
+    def memoize(self, key, compute):
+        if key not in self.memo:
+            self.memo[key] = compute()
+        return self.memo[key]
 
-        return features
+    def get_node_similarity(self):
+        """
+        Cosine similarity of every node of s1 to every node of s2.
+        Computed exactly, so near ties of Hungarian matching and token match thresholds resolve like spaCy similarity.
+        """
+        return self.memoize('node_similarity', lambda: self.s1.get_node_vectors().similarity(
+            self.s2.get_node_vectors(), exact=True
+        ))
+
+    def get_node_text_equality(self):
+        return self.memoize(
+            'node_text_equality',
+            lambda: self.s1.get_node_texts()[:, None] == self.s2.get_node_texts()[None, :]
+        )
 
+    def get_node_both_have_vector(self):
+        return self.memoize('node_both_have_vector', lambda: np.logical_and.outer(
+            self.s1.get_node_has_vector(),
+            self.s2.get_node_has_vector()
+        ))
 
-class HungarianNodeFeatureGenerator:
-    NAME = 'HungarianNode'
+    def get_basic_node_similarity(self):
+        """
+        NodeSimilarity.basic for every node of s1 and every node of s2
+        """
+        return self.memoize('basic_node_similarity', lambda: np.where(
+            self.get_node_both_have_vector(),
+            self.get_node_similarity(),
+            self.get_node_text_equality()
+        ))
 
-    def get_features_for_graphs(self, node_matcher, similarity):
-        node_matcher.set_threshold(similarity)
-        g1, g2 = node_matcher.get_converted_graphs()
-        n1, n2 = len(g1), len(g2)
-        num_matched_nodes = len(node_matcher.graph1_to_graph2)
-        percent_matched = num_matched_nodes * 2. / (n1 + n2)
-        features = np.array([n1, n2, percent_matched])
-        return features
+    def get_hungarian_similarity(self):
+        """
+        HungarianGraphNodesMatcher.create_cost_matrix similarity for every node of s1 and every node of s2.
+        spaCy similarity of tokens with the same text is 1.
+        """
 
-    def get_features(self, s1, s2):
-        g1 = get_dependancy_graph(s1, False)
-        g2 = get_dependancy_graph(s2, False)
-        node_matcher = HungarianGraphNodesMatcher(g1, g2, 0.9)
+        def build():
+            text_equality = self.get_node_text_equality()
+            same_kind = self.s1.get_node_is_fake()[:, None] == self.s2.get_node_is_fake()[None, :]
+            return np.where(
+                self.get_node_both_have_vector(),
+                np.where(text_equality, 1., self.get_node_similarity()),
+                np.where(same_kind, text_equality, 0.)
+            )
 
-        features = np.array([])
+        return self.memoize('hungarian_similarity', build)
 
-        for similarity in [0.8, 0.85, 0.90, 0.95]:
-            features = np.append(features, self.get_features_for_graphs(node_matcher, similarity))
+    def get_token_matches(self, similarity=0.9):
+        """
+        Tokens are matched if they have the same text or their spaCy similarity is at least similarity.
+        """
+        return self.memoize(('token_matches', similarity), lambda: np.logical_or(
+            self.get_node_text_equality()[1:, 1:],
+            self.get_node_similarity()[1:, 1:] >= similarity
+        ))
 
-        return features
+    def get_basic_token_matches(self, similarity=0.9):
+        """
+        Tokens are matched if NodeSimilarity.token_similarity is at least similarity.
+        """
+        return self.memoize(('basic_token_matches', similarity), lambda: (
+            self.get_basic_node_similarity()[1:, 1:] >= similarity
+        ))
 
+    # Longest n-gram any feature compares
+    MAX_N_GRAM = 4
 
-class PathFeatureGenerator:
-    NAME = 'PathSimilarity'
+    def get_n_gram_match_counts(self, basic=False):
+        """
+        Return (counts1, counts2), number of matched n-grams of s1 and of s2 for n = 1..MAX_N_GRAM
+        from one run length matrix (see MatchFeatureVectors.count_matched_n_grams_all).
+        basic - match tokens with get_basic_token_matches instead of get_token_matches
+        """
+        return self.memoize(('n_gram_match_counts', basic), lambda: MatchFeatureVectors.count_matched_n_grams_all(
+            self.get_basic_token_matches() if basic else self.get_token_matches(),
+            self.MAX_N_GRAM
+        ))
 
-    SIMILARITY = 0.8
+    def get_path_match_counts(self):
+        """
+        Matched paths of n nodes for n = 1..MAX_N_GRAM in both directions,
+        nodes match when NodeSimilarity.basic is at least 0.9 (see MatchFeatureVectors.count_matched_paths_all)
+        """
+        return self.memoize('path_match_counts', lambda: MatchFeatureVectors.count_matched_paths_all(
+            self.get_basic_node_similarity() >= 0.9,
+            self.s1.get_dependancy_tree(),
+            self.s2.get_dependancy_tree(),
+            self.MAX_N_GRAM
+        ))
+
+    def get_edge_matches(self, similarity):
+        """
+        Boolean matrix, edge i of s1 matches edge j of s2 if start and end nodes
+        of both have vectors and are similar.
+        """
+
+        def build():
+            start1, end1, _ = self.s1.get_edges()
+            start2, end2, _ = self.s2.get_edges()
+            has_vector1 = self.s1.get_node_has_vector()
+            has_vector2 = self.s2.get_node_has_vector()
+            node_similarity = self.get_node_similarity()
+
+            matches = np.logical_and.outer(
+                has_vector1[start1] & has_vector1[end1],
+                has_vector2[start2] & has_vector2[end2]
+            )
+            matches &= node_similarity[np.ix_(start1, start2)] > similarity
+            matches &= node_similarity[np.ix_(end1, end2)] > similarity
+            return matches
 
-    def get_feature_for_length(self, g_f1, g_f2, length):
-        f1 = g_f1.get_path_features(length=length)
-        f2 = g_f2.get_path_features(length=length)
+        return self.memoize(('edge_matches', similarity), build)
 
-        norm = len(f1) + len(f2)
+    def get_dependancy_type_equality(self):
+        return self.memoize(
+            'dependancy_type_equality',
+            lambda: self.s1.get_edges()[2][:, None] == self.s2.get_edges()[2][None, :]
+        )
 
-        features = np.array([])
-        for similarity in [0.8, 0.85, 0.90, 0.95]:
-            score = MatchFeatureVectors.match_feature_vectors(f1, f2, similarity)
-            score = (score * 2.) / norm if norm != 0 else 0
+    def get_node_matcher(self):
+        return self.memoize('node_matcher', lambda: HungarianGraphNodesMatcher(
+            self.s1.get_dependancy_graph(),
+            self.s2.get_dependancy_graph(),
+            0.9,
+            self.get_hungarian_similarity()
+        ))
 
-            features = np.append(features, score)
+    def get_converted_graphs(self, similarity):
+        """
+        Return graphs with nodes matched on similarity threshold
+        and the matching itself.
+        Graphs for all SIMILARITY_THRESHOLDS are built together, thresholds
+        with the same matching share the same graphs.
+        """
+        converted_graphs = self.memoize(
+            'converted_graphs',
+            lambda: self.get_node_matcher().get_converted_graphs_for_thresholds(SIMILARITY_THRESHOLDS)
+        )
+        return converted_graphs[similarity]
 
-        return features
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+class FeatureColumn:
+    """
+    One named output column of a feature generator.
+    compute - Function that takes PairAnalysis and *args and returns a number
+    generator - NAME of the generator the column belongs to, its compute time is reported under it
+    swapped - Name of the column with the value of this one for the swapped pair (s2, s1), None if there is none
+    """
 
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
+    def __init__(self, name, compute, *args):
+        self.name = name
+        self.compute_funct = compute
+        self.args = args
+        self.generator = None
+        self.swapped = None
 
-        features = np.array([])
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 0))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 1))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 2))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 3))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 4))
+    def compute(self, pair):
+        return self.compute_funct(pair, *self.args)
 
-        return features
 
+class ColumnFeatureGenerator:
+    """
+    Feature generator defined by list of FeatureColumn.
+    Only requested columns are computed, shared sub-computations are memoized in PairAnalysis.
+    """
 
-class SubtreeFeatureGenerator:
-    NAME = 'SubtreeFeature'
+    def get_columns(self):
+        raise NotImplementedError
+
+    def get_feature_names(self):
+        return [column.name for column in self.get_columns()]
+
+    def get_swapped_name(self, name):
+        """
+        Return name of the column that holds the value of column name for the swapped pair (s2, s1),
+        None if it has to be computed (e.g. Hungarian matching can break ties differently on the transposed matrix)
+        """
+        return None
+
+    def get_features(self, s1, s2, feature_names=None, pair=None):
+        """
+        feature_names - If present, compute only these columns in this order
+        pair - Optional PairAnalysis of s1 and s2, its memoized sub-computations are reused
+        """
+        if pair is None:
+            pair = PairAnalysis(s1, s2)
+
+        columns = self.get_columns()
+        if feature_names is not None:
+            name_to_column = {column.name: column for column in columns}
+            columns = [name_to_column[name] for name in feature_names]
+
+        if not stage_metrics.enabled:
+            return np.array([column.compute(pair) for column in columns], dtype=float)
+
+        # Shared sub-computations are timed in the first generator that needs them
+        values = []
+        times = {}
+        for column in columns:
+            start = time.perf_counter()
+            values.append(column.compute(pair))
+            stage = column.generator or self.NAME
+            times[stage] = times.get(stage, 0.) + time.perf_counter() - start
+        for stage, seconds in times.items():
+            stage_metrics.observe(stage, seconds)
+
+        return np.array(values, dtype=float)
+
+
+class HungarianGraphFeatureGenerator(ColumnFeatureGenerator):
+    NAME = 'HungarianGraph'
+
+    def get_graph_distance(self, pair, similarity, use_normalized):
+        g1, g2, graph1_to_graph2 = pair.get_converted_graphs(similarity)
+        matching = tuple(sorted(graph1_to_graph2.items()))
+
+        def compute():
+            with stage_metrics.timer('ged'):
+                return FastGraphEditDistance(g1, g2).distances()
+
+        distance, normalized_distance = pair.memoize(('graph_distance', matching), compute)
+        return normalized_distance if use_normalized else distance
+
+    def get_columns(self):
+        columns = []
+        for similarity in SIMILARITY_THRESHOLDS:
+            columns += [
+                FeatureColumn('%s_%s_normalized' % (self.NAME, similarity), self.get_graph_distance, similarity, True),
+                FeatureColumn('%s_%s_raw' % (self.NAME, similarity), self.get_graph_distance, similarity, False),
+            ]
+        return columns
+
+
+class HungarianNodeFeatureGenerator(ColumnFeatureGenerator):
+    NAME = 'HungarianNode'
+
+    def get_graph_len(self, pair, similarity, index):
+        graphs = pair.get_converted_graphs(similarity)
+        return len(graphs[index])
+
+    def get_percent_matched(self, pair, similarity):
+        g1, g2, _ = pair.get_converted_graphs(similarity)
+        n1, n2 = len(g1), len(g2)
+        num_matched_nodes = pair.memoize(
+            'num_matched_nodes',
+            lambda: pair.get_node_matcher().count_matched_nodes(SIMILARITY_THRESHOLDS)
+        )[SIMILARITY_THRESHOLDS.index(similarity)]
+        return num_matched_nodes * 2. / (n1 + n2)
+
+    def get_columns(self):
+        columns = []
+        for similarity in SIMILARITY_THRESHOLDS:
+            columns += [
+                FeatureColumn('%s_%s_n1' % (self.NAME, similarity), self.get_graph_len, similarity, 0),
+                FeatureColumn('%s_%s_n2' % (self.NAME, similarity), self.get_graph_len, similarity, 1),
+                FeatureColumn('%s_%s_percent' % (self.NAME, similarity), self.get_percent_matched, similarity),
+            ]
+        return columns
+
+
+class PathFeatureGenerator(ColumnFeatureGenerator):
+    NAME = 'PathSimilarity'
 
     SIMILARITY = 0.8
 
-    def get_feature_for_length(self, g_f1, g_f2, length):
-        f1 = g_f1.get_subtree_features(length=length)
-        f2 = g_f2.get_subtree_features(length=length)
+    def get_feature_vectors(self, s, length):
+        return s.get_path_vectors(length)
 
-        norm = len(f1) + len(f2)
+    def get_features_for_length(self, pair, length):
+        """
+        Return scores for all SIMILARITY_THRESHOLDS, the best match of every vector is found once.
+        """
 
-        features = np.array([])
-        for similarity in [0.8, 0.85, 0.90, 0.95]:
-            score = MatchFeatureVectors.match_feature_vectors(f1, f2, similarity)
-            score = (score * 2.) / norm if norm != 0 else 0
+        def compute():
+            similarity_matrix = self.get_feature_vectors(pair.s1, length).similarity(
+                self.get_feature_vectors(pair.s2, length)
+            )
 
-            features = np.append(features, score)
+            norm = sum(similarity_matrix.shape)
+            if norm == 0:
+                return np.zeros(len(SIMILARITY_THRESHOLDS))
 
-        return features
+            scores = MatchFeatureVectors.count_above_thresholds(
+                MatchFeatureVectors.get_best_match_similarities(similarity_matrix),
+                SIMILARITY_THRESHOLDS
+            )
+            return (scores * 2.) / norm
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+        return pair.memoize((self.NAME, length), compute)
 
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
+    def get_feature_for_length(self, pair, length, similarity):
+        return self.get_features_for_length(pair, length)[SIMILARITY_THRESHOLDS.index(similarity)]
 
-        features = np.array([])
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 0))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 1))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 2))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 3))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 4))
+    def get_columns(self):
+        return [
+            FeatureColumn('%s_%d_%s' % (self.NAME, length, similarity), self.get_feature_for_length, length, similarity)
+            for length in range(MAX_PATH_LENGTH + 1)
+            for similarity in SIMILARITY_THRESHOLDS
+        ]
 
-        return features
+
+class SubtreeFeatureGenerator(PathFeatureGenerator):
+    NAME = 'SubtreeFeature'
+
+    def get_feature_vectors(self, s, length):
+        return s.get_subtree_vectors(length)
 
 
-class RootNodeFeatureGenerator:
+class RootNodeFeatureGenerator(ColumnFeatureGenerator):
     NAME = 'RootNodeFeature'
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+    def get_root_similarity(self, pair):
+        root1 = pair.s1.get_root_node_index()
+        root2 = pair.s2.get_root_node_index()
 
-        root_node1 = GraphBuilder.get_root_node(g1)
-        root_node2 = GraphBuilder.get_root_node(g2)
+        if pair.s1.get_node_has_vector()[root1] and pair.s2.get_node_has_vector()[root2]:
+            # spaCy Token.similarity: same text is 1, cosine of vectors otherwise
+            if pair.get_node_text_equality()[root1, root2]:
+                return 1.0
+            return Vector.similarity(pair.s1.get_token_vectors()[0][root1], pair.s2.get_token_vectors()[0][root2])
+        return 0
 
-        if root_node1['token'].has_vector and root_node2['token'].has_vector:
-            score = root_node1['token'].similarity(root_node2['token'])
-        else:
-            score = 0
+    def get_swapped_name(self, name):
+        return name
 
-        features = np.array([
-            score,
-        ])
+    def get_columns(self):
+        return [FeatureColumn(self.NAME, self.get_root_similarity)]
 
-        return features
 
-
-class SimpleEdgeMatcher:
+class SimpleEdgeMatcher(ColumnFeatureGenerator):
     NAME = 'SimpleEdgeMatcher'
 
     SIMILARITY = 0.8
 
-    def simple_match_edges(self, g_f1, g_f2):
-        f1 = g_f1.get_simple_edge_features()
-        f2 = g_f2.get_simple_edge_features()
+    def simple_match_edges(self, pair):
+        matches = pair.get_edge_matches(self.SIMILARITY)
 
-        score = 0
-        for edge1 in f1:
-            if (edge1['start_node']['token'] is None or
-                    not edge1['start_node']['token'].has_vector
-                    or edge1['end_node']['token'] is None
-                    or not edge1['end_node']['token'].has_vector):
-                continue
-            for edge2 in f2:
-                if (edge2['start_node']['token'] is None
-                        or not edge2['start_node']['token'].has_vector
-                        or edge2['end_node']['token'] is None
-                        or not edge2['end_node']['token'].has_vector):
-                    continue
-                if (Vector.similarity(
-                        edge1['start_node']['token'].vector,
-                        edge2['start_node']['token'].vector
-                ) > self.SIMILARITY
-                        and Vector.similarity(
-                            edge1['end_node']['token'].vector,
-                            edge2['end_node']['token'].vector
-                        ) > self.SIMILARITY
-                ):
-                    score += 1
-
-        similarity_score = (1. * score) / (len(f1) * len(f2))
+        score = int(matches.sum())
 
-        return similarity_score
+        similarity_score = (1. * score) / (matches.shape[0] * matches.shape[1])
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+        return similarity_score
 
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
+    def get_simple_match_edges(self, pair):
+        return pair.memoize('simple_match_edges', lambda: self.simple_match_edges(pair))
 
-        features = np.array([
-            self.simple_match_edges(g_f1, g_f2)
-        ])
+    def get_swapped_name(self, name):
+        return name
 
-        return features
+    def get_columns(self):
+        return [FeatureColumn(self.NAME, self.get_simple_match_edges)]
 
 
-class SimpleEdgeMatcherWithDependancy:
+class SimpleEdgeMatcherWithDependancy(ColumnFeatureGenerator):
     NAME = 'SimpleEdgeMatcherWithDependancy'
 
     SIMILARITY = 0.8
 
-    def simple_match_edges_with_dependancy_type(self, g_f1, g_f2):
-        f1 = g_f1.get_simple_edge_features()
-        f2 = g_f2.get_simple_edge_features()
-
-        score = 0
-        total = 0
-        for edge1 in f1:
-            if (edge1['start_node']['token'] is None or
-                    not edge1['start_node']['token'].has_vector
-                    or edge1['end_node']['token'] is None
-                    or not edge1['end_node']['token'].has_vector):
-                continue
-            for edge2 in f2:
-                if (edge2['start_node']['token'] is None
-                        or not edge2['start_node']['token'].has_vector
-                        or edge2['end_node']['token'] is None
-                        or not edge2['end_node']['token'].has_vector):
-                    continue
-                if (Vector.similarity(
-                        edge1['start_node']['token'].vector,
-                        edge2['start_node']['token'].vector
-                ) > self.SIMILARITY
-                        and Vector.similarity(
-                            edge1['end_node']['token'].vector,
-                            edge2['end_node']['token'].vector
-                        ) > self.SIMILARITY
-                ):
-                    if (edge1['dependancy_type'] == edge2['dependancy_type']):
-                        score += 1
-                    total += 1
+    def simple_match_edges_with_dependancy_type(self, pair):
+        matches = pair.get_edge_matches(self.SIMILARITY)
+
+        score = int((matches & pair.get_dependancy_type_equality()).sum())
+        total = int(matches.sum())
 
         similarity_score = 0 if total == 0 else (1. * score) / total
 
         return similarity_score
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
-
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
-
-        features = np.array([
-            self.simple_match_edges_with_dependancy_type(g_f1, g_f2)
-        ])
+    def get_simple_match_edges_with_dependancy_type(self, pair):
+        return self.simple_match_edges_with_dependancy_type(pair)
 
-        simple_edge_matcher_feature_generator = SimpleEdgeMatcher()
-        features = np.append(features, simple_edge_matcher_feature_generator.get_features(s1, s2))
+    def get_swapped_name(self, name):
+        return name
 
-        return features
+    def get_columns(self):
+        return [
+            FeatureColumn(self.NAME, self.get_simple_match_edges_with_dependancy_type),
+            FeatureColumn('%s_%s' % (self.NAME, SimpleEdgeMatcher.NAME), SimpleEdgeMatcher().get_simple_match_edges),
+        ]
 
 
-class SimpleApproximateBigramKernel:
+class SimpleApproximateBigramKernel(ColumnFeatureGenerator):
     """
     There was an error here while training!, probably better to remove this feature.
           From https://www.aclweb.org/anthology/L16-1452.pdf
@@ -553,269 +1137,235 @@ class SimpleApproximateBigramKernel:
         return (start_node_similarity + end_node_similarity) * edge_similarity
 
     @classmethod
-    def compute_simple_approximate_bigram_kernel(cls, g_f1, g_f2):
-        f1 = g_f1.get_simple_edge_features()
-        f2 = g_f2.get_simple_edge_features()
+    def compute_simple_approximate_bigram_kernel(cls, pair):
+        """
+        Vectorized sum of similarity over all pairs of edges, rounded like the per edge loop:
+        two vector similarities are added in float32, a text equality promotes the sum to float64,
+        and the edge pairs are accumulated one after another.
+        """
+        start1, end1, _ = pair.s1.get_edges()
+        start2, end2, _ = pair.s2.get_edges()
+        # NodeSimilarity.basic is float32
+        node_similarity = pair.get_basic_node_similarity().astype(np.float32)
+        both_have_vector = pair.get_node_both_have_vector()
+
+        start_similarity = node_similarity[np.ix_(start1, start2)]
+        end_similarity = node_similarity[np.ix_(end1, end2)]
+        node_similarity_sum = np.where(
+            both_have_vector[np.ix_(start1, start2)] & both_have_vector[np.ix_(end1, end2)],
+            start_similarity + end_similarity,
+            start_similarity.astype(np.float64) + end_similarity
+        )
 
-        similarity_score = 0
+        edge_similarity = np.where(pair.get_dependancy_type_equality(), cls.EDGE_SIMILARITY_SCORE, 1)
 
-        for edge1 in f1:
-            for edge2 in f2:
-                similarity_score += cls.similarity(edge1, edge2)
+        # cumsum adds in order, sum() would use pairwise summation
+        terms = (node_similarity_sum * edge_similarity).ravel()
+        similarity_score = np.cumsum(terms)[-1] if terms.size else 0
 
-        similarity_score = (similarity_score * 1.) / (len(g_f1.g.nodes) + len(g_f2.g.nodes))
+        similarity_score = (similarity_score * 1.) / (
+            pair.s1.get_dependancy_tree().size + pair.s2.get_dependancy_tree().size
+        )
 
         return similarity_score
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+    def get_simple_approximate_bigram_kernel(self, pair):
+        return self.compute_simple_approximate_bigram_kernel(pair)
 
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
+    def get_columns(self):
+        return [FeatureColumn(self.NAME, self.get_simple_approximate_bigram_kernel)]
 
-        features = np.array([
-            SimpleApproximateBigramKernel.compute_simple_approximate_bigram_kernel(g_f1, g_f2)
-        ])
 
-        return features
+class SubtreeFeatureGeneratorIdf(PathFeatureGenerator):
+    NAME = 'SubtreeFeatureIdf'
 
+    def get_feature_vectors(self, s, length):
+        return s.get_subtree_vectors(length, idf_model=idf_model)
 
-class SubtreeFeatureGeneratorIdf:
-    NAME = 'SubtreeFeatureIdf'
 
-    SIMILARITY = 0.8
+class MarchFeatureGenerator(ColumnFeatureGenerator):
+    NAME = 'MarchFeature'
 
-    def get_feature_for_length(self, g_f1, g_f2, length):
-        f1 = g_f1.get_subtree_features(length=length, idf_model=idf_model)
-        f2 = g_f2.get_subtree_features(length=length, idf_model=idf_model)
+    BLEU_N_GRAMS = [1, 2, 3, 4]
 
-        norm = len(f1) + len(f2)
+    def get_len_difference(self, pair, swap, index):
+        s1, s2 = (pair.s2, pair.s1) if swap else (pair.s1, pair.s2)
 
-        features = np.array([])
-        for similarity in [0.8, 0.85, 0.90, 0.95]:
-            score = MatchFeatureVectors.match_feature_vectors(f1, f2, similarity)
-            score = (score * 2.) / norm if norm != 0 else 0
+        len_s1 = GeneralFeatures.get_s_len(s1)[0]
+        len_s2 = GeneralFeatures.get_s_len(s2)[0]
 
-            features = np.append(features, score)
+        if index == 0:
+            return (len_s1 - len_s2) * 1. / len_s1
+        return 1. / 0.8 ** (len_s1 - len_s2)
 
-        return features
+    def compare_n_grams(self, s1, s2, n):
+        """
+        Pairwise comparison of n-grams, only used for sentences shorter than n - 1 tokens
+        where n-grams are truncated (see GeneralFeatures.get_n_grams).
+        """
+        s1_list = GeneralFeatures.get_n_grams(s1, n)
+        s2_list = GeneralFeatures.get_n_grams(s2, n)
 
-    def get_features(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+        def is_n_gram_equal(n_gram_1, n_gram_2):
+            for i in range(len(n_gram_1)):
+                if n_gram_1[i].text != n_gram_2[i].text:
+                    if n_gram_1[i].similarity(n_gram_2[i]) < 0.9:
+                        return False
+            return True
 
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
+        count = 0
+        for n_gram_1 in s1_list:
+            match = False
+            for n_gram_2 in s2_list:
+                if is_n_gram_equal(n_gram_1, n_gram_2):
+                    match = True
+                    break
+            if match:
+                count += 1
+        return count * 1. / len(s1_list) if len(s1_list) > 0 else 0
 
-        features = np.array([])
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 0))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 1))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 2))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 3))
-        features = np.append(features, self.get_feature_for_length(g_f1, g_f2, 4))
+    def get_n_gram_similarity(self, pair, swap, n):
+        s1, s2 = (pair.s2, pair.s1) if swap else (pair.s1, pair.s2)
 
-        return features
+        matches = pair.get_token_matches()
+        if not MatchFeatureVectors.has_full_n_grams(matches, n):
+            return self.compare_n_grams(s1, s2, n)
 
+        n_grams_len = matches.shape[1 if swap else 0] - n + 1
+        count = pair.get_n_gram_match_counts()[1 if swap else 0][n - 1]
+        return count * 1. / n_grams_len if n_grams_len > 0 else 0
 
-class MarchFeatureGenerator:
-    NAME = 'MarchFeature'
+    def get_dependancy_matches(self, pair):
+        """
+        Boolean matrix, edge i of s1 matches edge j of s2 if they have the same dependancy type
+        and both start and end nodes are similar.
+        """
+
+        def build():
+            start1, end1, _ = pair.s1.get_edges()
+            start2, end2, _ = pair.s2.get_edges()
+            node_similarity = pair.get_basic_node_similarity()
 
-    def get_feature_1(self, s1, s2):
-        len_s1 = GeneralFeatures.get_s_len(s1)
-        len_s2 = GeneralFeatures.get_s_len(s2)
-
-        def f(len_s1, len_s2):
-            d_1 = (len_s1 - len_s2) * 1. / len_s1
-            d_2 = 1. / 0.8 ** (len_s1 - len_s2)
-            r = np.array([d_1, d_2])
-            return r
-
-        feature_1 = np.array([])
-        feature_1 = np.append(feature_1, f(len_s1, len_s2))
-        feature_1 = np.append(feature_1, f(len_s2, len_s1))
-        return feature_1
-
-    def get_feature_2(self, s1, s2):
-        doc_1 = nlp(s1)
-        doc_2 = nlp(s2)
-
-        def compare_n_grams(s1, s2, doc_1, doc_2, n):
-            s1_list = GeneralFeatures.get_n_grams(s1, n, doc_1)
-            s2_list = GeneralFeatures.get_n_grams(s2, n, doc_2)
-
-            def is_n_gram_equal(n_gram_1, n_gram_2):
-                for i in range(len(n_gram_1)):
-                    if n_gram_1[i].text != n_gram_2[i].text:
-                        if n_gram_1[i].similarity(n_gram_2[i]) < 0.9:
-                            return False
-                return True
-
-            count = 0
-            for n_gram_1 in s1_list:
-                match = False
-                for n_gram_2 in s2_list:
-                    if is_n_gram_equal(n_gram_1, n_gram_2):
-                        match = True
-                if match:
-                    count += 1
-            d = count * 1. / len(s1_list) if len(s1_list) > 0 else 0
-            return np.array([d])
-
-        feature_2 = np.array([])
-
-        feature_2 = np.append(feature_2, compare_n_grams(s1, s2, doc_1, doc_2, 1))
-        feature_2 = np.append(feature_2, compare_n_grams(s2, s1, doc_2, doc_1, 1))
-        feature_2 = np.append(feature_2, compare_n_grams(s1, s2, doc_1, doc_2, 2))
-        feature_2 = np.append(feature_2, compare_n_grams(s2, s1, doc_2, doc_1, 2))
-        feature_2 = np.append(feature_2, compare_n_grams(s1, s2, doc_1, doc_2, 3))
-        feature_2 = np.append(feature_2, compare_n_grams(s2, s1, doc_2, doc_1, 3))
-
-        return feature_2
-
-    def get_feature_4(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
-
-        g_f1 = GraphFeatures(g1)
-        g_f2 = GraphFeatures(g2)
-
-        f1 = g_f1.get_simple_edge_features()
-        f2 = g_f2.get_simple_edge_features()
-
-        def edge_similarity(edge1, edge2):
             return (
-                    (edge1['dependancy_type'] == edge2['dependancy_type'])
-                    and NodeSimilarity.basic(edge1['start_node'], edge2['start_node']) > 0.9
-                    and NodeSimilarity.basic(edge1['end_node'], edge2['end_node']) > 0.9
+                pair.get_dependancy_type_equality()
+                & (node_similarity[np.ix_(start1, start2)] > 0.9)
+                & (node_similarity[np.ix_(end1, end2)] > 0.9)
             )
 
-        def get_dependancy_similarity(f1, f2):
-            similarity_score = 0
-
-            for edge1 in f1:
-                match = False
-                for edge2 in f2:
-                    if edge_similarity(edge1, edge2):
-                        match = True
-                if match:
-                    similarity_score += 1
+        return pair.memoize('dependancy_matches', build)
 
-            similarity_score = (similarity_score * 1.) / len(f1) if len(f1) > 0 else 0
+    def get_edge_similarity(self, pair, swap):
+        matches = self.get_dependancy_matches(pair)
+        if swap:
+            matches = matches.T
 
-            return np.array([similarity_score])
+        similarity_score = MatchFeatureVectors.count_matched_rows(matches)
 
-        feature_4 = np.array([])
-        feature_4 = np.append(feature_4, get_dependancy_similarity(f1, f2))
-        feature_4 = np.append(feature_4, get_dependancy_similarity(f2, f1))
+        return (similarity_score * 1.) / matches.shape[0] if matches.shape[0] > 0 else 0
 
-        return feature_4
+    def get_path_n_gram_similarity(self, pair, swap, n):
+        counts1, counts2, totals1, totals2 = pair.get_path_match_counts()
+        count, total = (counts2[n - 1], totals2[n - 1]) if swap else (counts1[n - 1], totals1[n - 1])
 
-    def get_feature_5(self, s1, s2):
-        g1 = GraphBuilder.build_nx_graph_from_sentance(s1)
-        g2 = GraphBuilder.build_nx_graph_from_sentance(s2)
+        return count * 1. / total if total > 0 else 0
 
-        def compare_n_grams(g1, g2, length):
-            # Length in traversal starts with 0
-            length = length - 1
-            traversal_1 = GraphTraversal(graph=g1)
-            traversal_2 = GraphTraversal(graph=g2)
+    def get_bleu(self, pair, swap, n_grams):
+        s1, s2 = (pair.s2, pair.s1) if swap else (pair.s1, pair.s2)
 
-            s1_list = traversal_1.get_all_paths_with_len(length=length)
-            s2_list = traversal_2.get_all_paths_with_len(length=length)
-
-            def is_n_gram_equal(g1, g2, n_gram_1, n_gram_2):
-                for i in range(len(n_gram_1)):
-                    if NodeSimilarity.basic(g1.nodes[n_gram_1[i]], g2.nodes[n_gram_2[i]]) < 0.9:
-                        return False
-                return True
-
-            count = 0
-            for n_gram_1 in s1_list:
-                match = False
-                for n_gram_2 in s2_list:
-                    if is_n_gram_equal(g1, g2, n_gram_1, n_gram_2):
-                        match = True
-                if match:
-                    count += 1
-            d = count * 1. / len(s1_list) if len(s1_list) > 0 else 0
-            return np.array([d])
-
-        feature_5 = np.array([])
-
-        feature_5 = np.append(feature_5, compare_n_grams(g1, g2, 1))
-        feature_5 = np.append(feature_5, compare_n_grams(g2, g1, 1))
-        feature_5 = np.append(feature_5, compare_n_grams(g1, g2, 2))
-        feature_5 = np.append(feature_5, compare_n_grams(g2, g1, 2))
-        feature_5 = np.append(feature_5, compare_n_grams(g1, g2, 3))
-        feature_5 = np.append(feature_5, compare_n_grams(g2, g1, 3))
-        feature_5 = np.append(feature_5, compare_n_grams(g1, g2, 4))
-        feature_5 = np.append(feature_5, compare_n_grams(g2, g1, 4))
-
-        return feature_5
-
-    def get_feature_6(self, s1, s2):
-
-        def get_bleu(s1, s2, n_grams):
-            return np.array([BLEUCalculator.compute(
+        matches = pair.get_basic_token_matches()
+        if not MatchFeatureVectors.has_full_n_grams(matches, n_grams):
+            return BLEUCalculator.compute(
                 s1,
                 s2,
                 GeneralFeatures.get_n_grams,
                 NGramSimilarity.basic_word,
                 n_grams
-            )])
+            )
 
-        feature_6 = np.array([])
+        # Hypothesis is s2 (columns of matches), s1 when swapped
+        ref_length, hyp_length = matches.shape[::-1] if swap else matches.shape
+        counts = pair.get_n_gram_match_counts(basic=True)[0 if swap else 1]
+        return BLEUCalculator.compute_from_counts(counts, ref_length, hyp_length, n_grams)
 
-        feature_6 = np.append(feature_6, get_bleu(s1, s2, 1))
-        feature_6 = np.append(feature_6, get_bleu(s2, s1, 1))
-        feature_6 = np.append(feature_6, get_bleu(s1, s2, 2))
-        feature_6 = np.append(feature_6, get_bleu(s2, s1, 2))
-        feature_6 = np.append(feature_6, get_bleu(s1, s2, 3))
-        feature_6 = np.append(feature_6, get_bleu(s2, s1, 3))
-        feature_6 = np.append(feature_6, get_bleu(s1, s2, 4))
-        feature_6 = np.append(feature_6, get_bleu(s2, s1, 4))
+    @classmethod
+    def get_direction_name(cls, swap):
+        return 's2_s1' if swap else 's1_s2'
 
-        return feature_6
+    def get_swapped_name(self, name):
+        """
+        Both directions are counted from one match matrix, the s1_s2 value of (s2, s1) is the s2_s1 value of (s1, s2)
+        """
+        forward, backward = self.get_direction_name(False), self.get_direction_name(True)
+        if forward in name:
+            return name.replace(forward, backward)
+        return name.replace(backward, forward)
 
-    def get_features(self, s1, s2):
-        features = np.array([])
+    def get_feature_1_columns(self):
+        return [
+            FeatureColumn('%s_len_%s_%d' % (self.NAME, self.get_direction_name(swap), index),
+                          self.get_len_difference, swap, index)
+            for swap in [False, True]
+            for index in [0, 1]
+        ]
 
-        features = np.append(features, self.get_feature_6(s1, s2))
+    def get_feature_2_columns(self):
+        return [
+            FeatureColumn('%s_n_gram_%d_%s' % (self.NAME, n, self.get_direction_name(swap)),
+                          self.get_n_gram_similarity, swap, n)
+            for n in [1, 2, 3]
+            for swap in [False, True]
+        ]
 
-        return features
+    def get_feature_4_columns(self):
+        return [
+            FeatureColumn('%s_edge_%s' % (self.NAME, self.get_direction_name(swap)), self.get_edge_similarity, swap)
+            for swap in [False, True]
+        ]
 
+    def get_feature_5_columns(self):
+        return [
+            FeatureColumn('%s_path_n_gram_%d_%s' % (self.NAME, n, self.get_direction_name(swap)),
+                          self.get_path_n_gram_similarity, swap, n)
+            for n in [1, 2, 3, 4]
+            for swap in [False, True]
+        ]
 
-class MarchFeatureGeneratorWithoutBleu(MarchFeatureGenerator):
-    NAME = 'MarchFeatureGeneratorWithoutBleu'
+    def get_feature_6_columns(self):
+        return [
+            FeatureColumn('%s_bleu_%d_%s' % (self.NAME, n_grams, self.get_direction_name(swap)),
+                          self.get_bleu, swap, n_grams)
+            for n_grams in self.BLEU_N_GRAMS
+            for swap in [False, True]
+        ]
 
-    def get_features(self, s1, s2):
-        features = np.array([])
+    def get_columns(self):
+        return self.get_feature_6_columns()
 
-        features = np.append(features, self.get_feature_1(s1, s2))
-        features = np.append(features, self.get_feature_2(s1, s2))
-        features = np.append(features, self.get_feature_4(s1, s2))
-        features = np.append(features, self.get_feature_5(s1, s2))
 
-        return features
+class MarchFeatureGeneratorWithoutBleu(MarchFeatureGenerator):
+    NAME = 'MarchFeatureGeneratorWithoutBleu'
+
+    def get_columns(self):
+        return (
+            self.get_feature_1_columns() +
+            self.get_feature_2_columns() +
+            self.get_feature_4_columns() +
+            self.get_feature_5_columns()
+        )
 
 
 class MarchFeatureGeneratorOnlyBleu(MarchFeatureGenerator):
     NAME = 'MarchFeatureGeneratorOnlyBleu'
 
-    def get_features(self, s1, s2):
-        features = np.array([])
-
-        features = np.append(features, self.get_feature_6(s1, s2))
-
-        return features
 
-
-class AllFeatureFinal:
+class AllFeatureFinal(ColumnFeatureGenerator):
     NAME = 'AllFeatureFinal'
 
-    def get_features(self, s1, s2):
-        generators = [
+    def __init__(self):
+        self.columns = None
+
+    def get_generators(self):
+        return [
             HungarianGraphFeatureGenerator(),
             HungarianNodeFeatureGenerator(),
             PathFeatureGenerator(),
@@ -828,10 +1378,46 @@ class AllFeatureFinal:
             MarchFeatureGeneratorWithoutBleu(),
             MarchFeatureGeneratorOnlyBleu()
         ]
-        features = np.array([])
-        for generator in generators:
-            features = np.append(features, generator.get_features(s1, s2))
-        return features
+
+    def get_columns(self):
+        if self.columns is None:
+            self.columns = []
+            for generator in self.get_generators():
+                for column in generator.get_columns():
+                    column.generator = generator.NAME
+                    column.swapped = generator.get_swapped_name(column.name)
+                    self.columns.append(column)
+        return self.columns
+
+    def get_swap_permutation(self, feature_names):
+        """
+        Return array, item i is the index in feature_names of the column that holds feature i
+        of the swapped pair (s2, s1), -1 if feature i can not be derived from the swapped pair
+        """
+        indexes = {name: index for index, name in enumerate(feature_names)}
+        name_to_column = {column.name: column for column in self.get_columns()}
+        return np.array([indexes.get(name_to_column[name].swapped, -1) for name in feature_names], dtype=int)
+
+    @classmethod
+    def test_parse_once(cls):
+        """
+            Every sentence of the pair has to be parsed by spaCy exactly once.
+        """
+        parse_count = SentenceAnalysis.parse_count
+
+        cls().get_features("the cat is on the mat", "the cat the cat on the mat")
+
+        assert SentenceAnalysis.parse_count - parse_count == 2
+
+    @classmethod
+    def test_feature_names(cls):
+        """
+            Every column has unique name.
+        """
+        feature_names = cls().get_feature_names()
+
+        assert len(feature_names) == len(set(feature_names))
+        assert len(feature_names) == len(FEATURE_BITMASK)
 
 
 # Code is taken from https://github.com/Jacobe2169/ged4py
@@ -990,13 +1576,95 @@ class GraphEditDistance(AbstractGraphEditDistance):
         return edit_edit_dist.normalized_distance()
 
 
-def compare_graphs(g1, g2, print_details=False, use_normalized=True):
-    ged = GraphEditDistance(g1, g2)
+class FastGraphEditDistance:
+    """
+    The same distance as GraphEditDistance, but:
+    - the cost matrix is built with vectorized operations,
+    - edge diff of all node pairs is computed in bulk. EdgeEditDistance between edges of node1
+      and node2 has closed form max(k, l) - (number of equal edges), because equal edges cost 0,
+      substitution costs 1 and insert + delete cost 2,
+    - instead of |N+M| X |N+M| matrix with sys.maxsize in insert and delete regions,
+      Hungarian algorithm solves |N| X |M| matrix of substitution gains
+      min(substitute - delete - insert, 0). Pair with zero gain is delete + insert.
+    - distance and normalized distance come from one solve.
+    """
+
+    def __init__(self, g1, g2):
+        self.g1 = g1
+        self.g2 = g2
+        self.nodes1 = list(g1.nodes())
+        self.nodes2 = list(g2.nodes())
+
+    def edge_diff_matrix(self):
+        degree1 = np.array([len(self.g1[node]) for node in self.nodes1])[:, None]
+        degree2 = np.array([len(self.g2[node]) for node in self.nodes2])[None, :]
+
+        # Only nodes with the same label can have equal edges
+        equal_edges = np.zeros((len(self.nodes1), len(self.nodes2)))
+        index2 = {node: j for j, node in enumerate(self.nodes2)}
+        for i, node in enumerate(self.nodes1):
+            if node in index2:
+                equal_edges[i, index2[node]] = len(set(self.g1[node]) & set(self.g2[node]))
+
+        max_degree = np.maximum(degree1, degree2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized = (max_degree - equal_edges) / (degree1 + degree2)
+
+        return np.where((degree1 == 0) | (degree2 == 0), max_degree, normalized)
 
-    if print_details:
-        ged.print_matrix()
+    def create_cost_matrix(self):
+        """
+        Substitution costs, relabel cost + edge diff
+        """
+        relabel = np.array(self.nodes1, dtype=object)[:, None] != np.array(self.nodes2, dtype=object)[None, :]
+        self.cost_matrix = relabel.astype(float) + self.edge_diff_matrix()
+        return self.cost_matrix
+
+    def edit_costs(self):
+        """
+        Costs in the order of GraphEditDistance.edit_costs:
+        substitution or deletion for every node of g1, then insertions.
+        """
+        n, m = len(self.nodes1), len(self.nodes2)
+        if n == 0 or m == 0:
+            return [1.] * (n + m)
 
-    return ged.normalized_distance() if use_normalized else ged.distance()
+        cost_matrix = self.create_cost_matrix()
+        # Deleting node of g1 and inserting node of g2 costs 2
+        gain_matrix = np.minimum(cost_matrix - 2, 0)
+        row_ind, col_ind = linear_sum_assignment(gain_matrix)
+
+        substituted = gain_matrix[row_ind, col_ind] < 0
+        row_ind, col_ind = row_ind[substituted], col_ind[substituted]
+
+        costs = np.ones(n)
+        costs[row_ind] = cost_matrix[row_ind, col_ind]
+
+        return list(costs) + [1.] * (m - len(col_ind))
+
+    def distances(self):
+        """
+        Return (distance, normalized distance)
+        """
+        distance = sum(self.edit_costs())
+        return distance, distance / (len(self.g1) + len(self.g2))
+
+    def distance(self):
+        return self.distances()[0]
+
+    def normalized_distance(self):
+        return self.distances()[1]
+
+    @classmethod
+    def test_distances(cls):
+        g1 = nx.Graph([("ROOT", "sat"), ("sat", "cat"), ("cat", "the"), ("sat", "mat")])
+        g2 = nx.Graph([("ROOT", "sat"), ("sat", "dog"), ("dog", "the"), ("sat", "on"), ("on", "mat")])
+
+        distance, normalized_distance = cls(g1, g2).distances()
+        ged = GraphEditDistance(g1, g2)
+
+        assert abs(distance - ged.distance()) < 1e-9
+        assert abs(normalized_distance - ged.normalized_distance()) < 1e-9
 
 
 class GraphBuilder:
@@ -1057,7 +1725,17 @@ class GraphFeatures:
 
         return aggregated_vectors
 
-    def get_subtree_features(self, length=0, remove_tree_without_vector=True, remove_stop_words=False, idf_model=None):
+    @classmethod
+    def get_node_weights(cls, g, idf_model=None):
+        """
+        Return float32 array with weight of every node: idf of its token or 1 without idf_model
+        """
+        if idf_model is None:
+            return np.ones(len(g.nodes), dtype=np.float32)
+        return idf_model.get_tokens_weights([g.nodes[node]["token"] for node in range(len(g.nodes))])
+
+    def get_subtree_features(self, length=0, remove_tree_without_vector=True, remove_stop_words=False, idf_model=None,
+                             node_weights=None):
         """
         Return list of vectors, where each vector represent one subtree.
         Subtree is created by aggregating vectors in this subtree.
@@ -1068,39 +1746,34 @@ class GraphFeatures:
           is empty (non common word)
         remove_stop_words - remove word from tree if it is stop word
         idf_model - If present, multiply vector by word idf
+        node_weights - Precomputed get_node_weights(g, idf_model)
         """
         traversal = GraphTraversal(graph=self.g)
         subtrees = traversal.get_all_subtrees_with_depth(length=length)
-
-        subtrees_with_nodes = [
-            [self.g.nodes[node] for node in subtree]
-            for subtree in subtrees
-        ]
+        tokens = [self.g.nodes[node]["token"] for node in range(len(self.g.nodes))]
 
         if remove_tree_without_vector:
-            subtrees_with_nodes = [
+            subtrees = [
                 subtree
-                for subtree in subtrees_with_nodes
+                for subtree in subtrees
                 if all(
-                    node["token"] is not None and node["token"].has_vector
+                    tokens[node] is not None and tokens[node].has_vector
                     for node in subtree
                 )
             ]
 
-        idf = lambda word: 1
-
-        if idf_model is not None:
-            idf = lambda word: idf_model.get_idf(word)
+        if node_weights is None:
+            node_weights = GraphFeatures.get_node_weights(self.g, idf_model)
 
         aggregated_vectors = [
             sum([
-                node["token"].vector * idf(node["token"])
+                tokens[node].vector * node_weights[node]
                 for node in subtree
                 # If remove_tree_without_vector == false
-                if node["token"] is not None and node["token"].has_vector
-                and (not remove_stop_words or not node["token"].is_stop)
+                if tokens[node] is not None and tokens[node].has_vector
+                and (not remove_stop_words or not tokens[node].is_stop)
             ])
-            for subtree in subtrees_with_nodes
+            for subtree in subtrees
         ]
 
         # Filter empty vectors
@@ -1235,39 +1908,149 @@ class Vector:
         return (np.dot(v1, v2) / (v1_norm * v2_norm))
 
 
+class VectorMatrix:
+    """
+    List of vectors stacked into one matrix with norms computed once,
+    so cosine similarities of all pairs come from one matrix multiply.
+    """
+
+    def __init__(self, vectors):
+        """
+        vectors - list of vectors or float32 matrix (used without copy)
+        """
+        if len(vectors) > 0:
+            self.matrix = np.asarray(vectors, dtype=np.float32)
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.norms = np.sqrt((self.matrix ** 2).sum(axis=1))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def similarity(self, other, exact=False):
+        """
+        Return len(self) X len(other) matrix, item [i][j] is Vector.similarity of vector i and vector j.
+        Similarity with zero vector is 0.
+        Values are computed in float32 like Vector.similarity, but returned as float64,
+        so they compare with thresholds the same way.
+        exact - Compute dot products pair by pair, so they are rounded exactly like Vector.similarity
+        and spaCy similarity, one matrix multiply sums in other order and can differ in the last bit
+        """
+        if self.matrix.size == 0 or other.matrix.size == 0:
+            return np.zeros((len(self), len(other)))
+
+        if exact:
+            dots = np.array([[np.dot(v1, v2) for v2 in other.matrix] for v1 in self.matrix], dtype=np.float32)
+        else:
+            dots = np.dot(self.matrix, other.matrix.T)
+        norms = np.outer(self.norms, other.norms)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = dots / norms
+        similarity[norms == 0] = 0
+
+        return similarity.astype(np.float64)
+
+
 class MatchFeatureVectors:
     @classmethod
-    def match_feature_vectors(cls, features1, features2, similarity=0.8):
+    def count_matched_rows(cls, matches):
         """
-          This function tries to do the following:
-          1) For each vector in features1 try to find whether vector with good similarity exist in features2.
-          Return ammount of matched vectors.
+        matches - boolean matrix
+        Return number of rows with at least one match
         """
-        count = 0
+        return int(matches.any(axis=1).sum())
 
-        features1_norm = []
-        for v1 in features1:
-            for v2 in features2:
-                score = Vector.similarity(v1, v2)
-                if score > similarity:
-                    count += 1
-                    break
-        return count
+    @classmethod
+    def get_best_match_similarities(cls, similarity_matrix):
+        """
+        Return similarity of the best match in features2 for each vector of features1
+        """
+        if similarity_matrix.shape[1] == 0:
+            return np.full(similarity_matrix.shape[0], -np.inf)
+        return similarity_matrix.max(axis=1)
+
+    @classmethod
+    def count_above_thresholds(cls, similarities, thresholds):
+        """
+        Return array with number of similarities greater than each threshold
+        """
+        return (similarities[:, None] > np.array(thresholds)[None, :]).sum(axis=0)
+
+    @classmethod
+    def has_full_n_grams(cls, matches, n):
+        """
+        GeneralFeatures.get_n_grams returns only n-grams of len n if sentence has at least n - 1 tokens.
+        """
+        return min(matches.shape) >= n - 1
+
+    @classmethod
+    def get_run_lengths(cls, matches, max_n):
+        """
+        matches - boolean matrix, matches[i][j] is True when token i of first sentence
+            is equal to token j of second sentence
+        Return matrix, item [i][j] is the number of matches on the diagonal starting at [i][j] (at most max_n),
+        n-gram starting at token i matches n-gram starting at token j when it is at least n.
+        """
+        rows, cols = matches.shape
+        runs = np.zeros((rows + 1, cols + 1), dtype=int)
+        for i in range(rows - 1, -1, -1):
+            runs[i, :cols] = np.where(matches[i], np.minimum(runs[i + 1, 1:] + 1, max_n), 0)
+        return runs[:rows, :cols]
+
+    @classmethod
+    def count_matched_n_grams_all(cls, matches, max_n):
+        """
+        Return (counts1, counts2), counts1[n - 1] is the number of n-grams of the first sentence
+        that have equal n-gram in the second one, counts2 the other way, for all n from 1 to max_n at once.
+        N-grams are equal when all their tokens are equal, so it is a diagonal of matches.
+        """
+        runs = cls.get_run_lengths(matches, max_n)
+        n = np.arange(1, max_n + 1)
+
+        def count(best_runs):
+            return (best_runs[:, None] >= n[None, :]).sum(axis=0)
+
+        if runs.size == 0:
+            return np.zeros(max_n, dtype=int), np.zeros(max_n, dtype=int)
+        return count(runs.max(axis=1)), count(runs.max(axis=0))
+
+    @classmethod
+    def count_matched_paths_all(cls, node_matches, tree1, tree2, max_n):
+        """
+        node_matches - boolean matrix of matched nodes of two DependancyTree
+        Return (counts1, counts2, totals1, totals2) for paths of n nodes, n from 1 to max_n:
+        counts1[n - 1] is the number of paths of tree1 matched by a path of tree2 (all their nodes are matched),
+        totals1[n - 1] number of paths of tree1, counts2 and totals2 the other way.
+        Paths ending at nodes v1, v2 match when v1 and v2 match and paths one node shorter ending at their parents match.
+        """
+        parent1 = np.maximum(tree1.parent, 0)
+        parent2 = np.maximum(tree2.parent, 0)
+        counts1, counts2, totals1, totals2 = [], [], [], []
+        path_matches = node_matches
+        for n in range(1, max_n + 1):
+            if n > 1:
+                path_matches = path_matches[np.ix_(parent1, parent2)] & node_matches
+            valid1 = tree1.depth >= n - 1
+            valid2 = tree2.depth >= n - 1
+            matches = path_matches[np.ix_(valid1, valid2)]
+            counts1.append(int(matches.any(axis=1).sum()))
+            counts2.append(int(matches.any(axis=0).sum()))
+            totals1.append(int(valid1.sum()))
+            totals2.append(int(valid2.sum()))
+        return counts1, counts2, totals1, totals2
 
 
 class GeneralFeatures:
 
     @classmethod
     def get_s_len(cls, s):
-        doc = nlp(s)
-        return np.array([len(doc)])
+        return SentenceAnalysis.of(s).get_len()
 
     @classmethod
     def get_n_grams(cls, s, n, doc=None):
         if doc is None:
-            d = nlp(s)
-        else:
-            d = doc
+            return SentenceAnalysis.of(s).get_n_grams(n)
+        d = doc
 
         res = []
         count = 0
@@ -1366,6 +2149,7 @@ class BLEUCalculator:
                     #                     print("*" * 20)
 
                     found = True
+                    break
             if found:
                 total_found += 1
 
@@ -1420,6 +2204,34 @@ class BLEUCalculator:
 
         return s
 
+    @classmethod
+    def compute_from_counts(cls, counts, ref_length, hyp_length, max_n):
+        """
+        counts - counts[n - 1] is the number of hypothesis n-grams found in reference (at least max_n items)
+
+        Return BLEU - double, the same as compute with n-grams of the whole sentences
+        """
+        p_n = []
+
+        weight = 1. / max_n
+
+        weights = [weight] * max_n
+
+        for i, _ in enumerate(weights, start=1):
+            numerator = counts[i - 1]
+            denominator = max(1, hyp_length - i + 1)
+            _p = (numerator * 1.) / denominator
+            if abs(_p) < 0.001:
+                return 0
+            p_n.append(_p)
+
+        bp = BrevityPenalty.compute(ref_length, hyp_length)
+
+        s = [w_i * math.log(p_i) for w_i, p_i in zip(weights, p_n)]
+        s = bp * math.exp(math.fsum(s))
+
+        return s
+
     @classmethod
     def test_precision(cls):
         """
@@ -1485,18 +2297,274 @@ class NGramSimilarity:
         return True
 
 
-def features_for_prediction(s1, s2):
-    feature_generator = AllFeatureFinal()
-    features = feature_generator.get_features(s1, s2)
+FEATURE_BITMASK = [
+    False, True, True, False, False, False, False, False, False, True, True, True, True, False, True, True,
+    False, True, True, True, True, True, False, False, True, False, False, False, False, True, True, True,
+    True, True, False, True, True, True, True, True, True, True, True, True, False, True, False, True, False,
+    True, True, False, False, False, True, False, True, False, False, True, True, False, False, True, True,
+    True, False, True, True, True, False, True, False, False, False, False, True, False, True, True, True,
+    True, True, False, True, True, False, True, True, False, False, True, False, False, False, False, True,
+    True, True, False, True, False, False, False, True, True, True, True, True, False, False, True, False]
+
+# Bump when the computation of any feature changes, persisted features of other versions are not used
+FEATURES_VERSION = 1
+
+# Columns of AllFeatureFinal the classifier was trained on
+PREDICTION_FEATURE_NAMES = [
+    name
+    for name, keep in zip(AllFeatureFinal().get_feature_names(), FEATURE_BITMASK)
+    if keep
+]
+
+
+class LRUCache:
+    """
+    Dict bounded by the total size of values, least recently used values are evicted first.
+    get_size - Function that takes value and returns its size in bytes
+    """
+
+    def __init__(self, max_size, get_size):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def peek(self, key):
+        """
+        Return value or None, not counted as hit or miss
+        """
+        with self.lock:
+            return self.items.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.sizes[key]
+            self.items[key] = value
+            self.sizes[key] = self.get_size(value)
+            self.size += self.sizes[key]
+            self.evict()
+
+    def update_size(self, key):
+        """
+        Value can grow after it was put (memoized artifacts)
+        """
+        with self.lock:
+            if key not in self.items:
+                return
+            size = self.get_size(self.items[key])
+            self.size += size - self.sizes[key]
+            self.sizes[key] = size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_size and self.items:
+            key, _ = self.items.popitem(last=False)
+            self.size -= self.sizes.pop(key)
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'items': len(self.items),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class FeatureCache:
+    """
+    Two level content addressed cache:
+    - SentenceAnalysis (parse, graphs, vectors, path and subtree aggregates) per sentence,
+    - final feature vectors per pair.
+    Keys are hashes of NFC normalized text, the analysis is built from the normalized text as well.
+    A pair missing in cache whose swapped pair (s2, s1) is cached takes over the direction independent
+    columns from it (AllFeatureFinal.get_swap_permutation), only the rest is computed.
+    store - Optional feature_store.FeatureStore shared between processes, consulted on pair misses
+    """
+
+    def __init__(self, max_sentences_size, max_pairs_size, store=None):
+        self.sentences = LRUCache(max_sentences_size, lambda analysis: analysis.get_size())
+        self.pairs = LRUCache(max_pairs_size, lambda features: features.nbytes)
+        self.store = store
+        self.swap_permutations = {}
+        self.swapped_hits = 0
+
+    @classmethod
+    def normalize(cls, s):
+        return unicodedata.normalize('NFC', s)
+
+    @classmethod
+    def get_key(cls, s):
+        return hashlib.sha1(cls.normalize(s).encode('utf8')).hexdigest()
+
+    def get_sentence_analysis(self, s):
+        return self.sentences.get(self.get_key(s), lambda: SentenceAnalysis(self.normalize(s)))
+
+    def get_sentence_analyses(self, sentences):
+        """
+        Return dict sentance -> SentenceAnalysis, sentences missing in cache are parsed with one nlp.pipe batch
+        """
+        sentences = list(dict.fromkeys(sentences))
+        with self.sentences.lock:
+            missing = [s for s in sentences if self.get_key(s) not in self.sentences.items]
+
+        parsed = SentenceAnalysis.analyse_sentences([self.normalize(s) for s in missing])
+
+        def analyse(s):
+            s = self.normalize(s)
+            return parsed[s] if s in parsed else SentenceAnalysis(s)
 
-    bitmask = [False, True, True, False, False, False, False, False, False, True, True, True, True, False, True, True,
-               False, True, True, True, True, True, False, False, True, False, False, False, False, True, True, True,
-               True, True, False, True, True, True, True, True, True, True, True, True, False, True, False, True, False,
-               True, True, False, False, False, True, False, True, False, False, True, True, False, False, True, True,
-               True, False, True, True, True, False, True, False, False, False, False, True, False, True, True, True,
-               True, True, False, True, True, False, True, True, False, False, True, False, False, False, False, True,
-               True, True, False, True, False, False, False, True, True, True, True, True, False, False, True, False]
+        return {
+            s: self.sentences.get(self.get_key(s), lambda: analyse(s))
+            for s in sentences
+        }
 
-    features_bm = features[bitmask].reshape(1, -1)
+    def get_features(self, s1, s2, feature_names, analyses=None, pair=None):
+        """
+        analyses - Optional dict sentance -> SentenceAnalysis from get_sentence_analyses
+        pair - Optional PairAnalysis of s1 and s2 to compute the features with
+        Return features of the pair, computed only if the pair is not in cache
+        """
+        key1 = self.get_key(s1)
+        key2 = self.get_key(s2)
+
+        def compute():
+            store = self.store
+            if store is not None:
+                pair_key = store.get_key(key1, key2, feature_names)
+                features = store.get(pair_key)
+                if features is not None and len(features) == len(feature_names):
+                    return features
+
+            if pair is not None:
+                a1, a2 = pair.s1, pair.s2
+            elif analyses is not None:
+                a1, a2 = analyses[s1], analyses[s2]
+            else:
+                a1, a2 = self.get_sentence_analysis(s1), self.get_sentence_analysis(s2)
+            swapped = self.pairs.peek((key2, key1, tuple(feature_names)))
+            if swapped is not None:
+                features = self.get_features_from_swapped(a1, a2, swapped, feature_names, pair)
+            else:
+                features = AllFeatureFinal().get_features(a1, a2, feature_names, pair)
+            self.sentences.update_size(key1)
+            self.sentences.update_size(key2)
+
+            if store is not None:
+                store.put(pair_key, features)
+            return features
+
+        return self.pairs.get((key1, key2, tuple(feature_names)), compute).copy()
+
+    def get_features_from_swapped(self, a1, a2, swapped, feature_names, pair=None):
+        """
+        swapped - Features of (s2, s1)
+        Return features of (s1, s2), columns without a counterpart in feature_names are computed
+        """
+        key = tuple(feature_names)
+        if key not in self.swap_permutations:
+            self.swap_permutations[key] = AllFeatureFinal().get_swap_permutation(feature_names)
+        permutation = self.swap_permutations[key]
+
+        derived = permutation >= 0
+        features = np.empty(len(feature_names))
+        features[derived] = swapped[permutation[derived]]
+        missing = np.where(~derived)[0]
+        if len(missing) > 0:
+            features[missing] = AllFeatureFinal().get_features(a1, a2, [feature_names[i] for i in missing], pair)
+        self.swapped_hits += 1
+        return features
+
+    @classmethod
+    def test_swapped_pair(cls):
+        """
+            Features derived from the swapped pair are the computed ones.
+        """
+        s1, s2 = "the cat is on the mat", "a cat sat on the mat"
+        feature_names = AllFeatureFinal().get_feature_names()
+        cache = cls(64 * 1024 * 1024, 1024 * 1024)
+
+        cache.get_features(s2, s1, feature_names)
+        features = cache.get_features(s1, s2, feature_names)
+
+        assert cache.swapped_hits == 1
+        assert np.allclose(features, AllFeatureFinal().get_features(s1, s2), equal_nan=True)
+
+    def get_stats(self):
+        pairs = self.pairs.get_stats()
+        pairs['swapped'] = self.swapped_hits
+        stats = {
+            'sentences': self.sentences.get_stats(),
+            'pairs': pairs,
+        }
+        if self.store is not None:
+            stats['store'] = self.store.get_stats()
+        return stats
+
+
+feature_cache = FeatureCache(
+    max_sentences_size=int(os.environ.get('FEATURE_CACHE_SENTENCES_SIZE', 64 * 1024 * 1024)),
+    max_pairs_size=int(os.environ.get('FEATURE_CACHE_PAIRS_SIZE', 16 * 1024 * 1024)),
+)
+
+
+def features_for_prediction(s1, s2, feature_names=None):
+    """
+    Return (1, n) matrix with features the classifier needs,
+    only these columns are computed.
+    """
+    if feature_names is None:
+        feature_names = PREDICTION_FEATURE_NAMES
+
+    with stage_metrics.timer('features'):
+        features = feature_cache.get_features(s1, s2, feature_names)
+
+    return features.reshape(1, -1)
+
+
+def features_for_prediction_batch(pairs, feature_names=None, pair_analyses=None):
+    """
+    pairs - list of (s1, s2)
+    pair_analyses - Optional dict (s1, s2) -> PairAnalysis, filled with the pairs it misses,
+        a later call with the same dict reuses their sub-computations (e.g. matched nodes for other columns)
+    Return (len(pairs), n) matrix with features the classifier needs,
+    every distinct sentence not in cache is parsed once for the whole batch.
+    """
+    if feature_names is None:
+        feature_names = PREDICTION_FEATURE_NAMES
+    if pair_analyses is None:
+        pair_analyses = {}
+
+    with stage_metrics.timer('features_batch'):
+        missing = [pair for pair in dict.fromkeys(pairs) if pair not in pair_analyses]
+        analyses = feature_cache.get_sentence_analyses([s for pair in missing for s in pair])
+        for s1, s2 in missing:
+            pair_analyses[(s1, s2)] = PairAnalysis(analyses[s1], analyses[s2])
+
+        features = [
+            feature_cache.get_features(s1, s2, feature_names, pair=pair_analyses[(s1, s2)])
+            for s1, s2 in pairs
+        ]
 
-    return features_bm
+    return np.array(features).reshape(len(pairs), len(feature_names))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Golden feature vectors guarding the optimized feature paths.
+
+    python parity.py record [--pairs N] [--path parity_golden.npz] [--commit BASELINE_COMMIT]
+    python parity.py check [--path parity_golden.npz] [--atol 1e-6] [--rtol 1e-6] [--workers N]
+
+record stores full AllFeatureFinal vectors of a seeded sample of MSRP pairs computed by the code
+of BASELINE_COMMIT (before any optimization, checked out to a temporary git worktree) pair by pair,
+so a regression in the shared feature code can not get into the reference. record runs only with the spaCy
+model pinned in requirements.txt (PINNED_SPACY_MODEL), the golden file keeps the model it was recorded with
+and check refuses it with another model. The golden file is committed once recorded.
+check recomputes the vectors through every path the service and the scripts use
+(single pair, cached, swapped, batched, parallel) and reports the features that differ by more than
+atol + rtol * |golden|. Exit code is 1 if any path differs, changes of the columns
+the classifier uses (PREDICTION_FEATURE_NAMES) are reported separately.
+"""
+import sys
+import os
+import argparse
+import json
+import logging
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+import model
+from model import AllFeatureFinal, FeatureCache, FEATURES_VERSION, PREDICTION_FEATURE_NAMES, nlp
+from corpus import extract_features
+from benchmark import get_pairs
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+PARITY_GOLDEN = os.path.join(APP_ROOT, 'parity_golden.npz')
+
+# Last commit before the feature code was optimized, the reference all paths are compared with
+BASELINE_COMMIT = '5a25192ce68966e3ef8cca18b64a8171360232aa'
+
+# spaCy model of requirements.txt, as lang_name-version of nlp.meta
+PINNED_SPACY_MODEL = 'en_core_web_sm-2.2.5'
+
+# Run in the worktree of the baseline commit: python -c REFERENCE_SCRIPT pairs.json features.npy
+REFERENCE_SCRIPT = """
+import sys, json
+import numpy as np
+sys.path.insert(0, '.')
+from model import AllFeatureFinal
+pairs = json.load(open(sys.argv[1]))
+np.save(sys.argv[2], np.array([AllFeatureFinal().get_features(s1, s2) for s1, s2 in pairs]))
+"""
+
+# Allowed difference is atol + rtol * |golden|, float32 IDF tables shift some features by ~1e-7,
+# FastGraphEditDistance sums tied assignments in another order (HungarianGraph columns move by ~1e-15),
+# the other sums keep the order of the baseline and are expected to be bit-identical
+DEFAULT_ATOL = 1e-6
+DEFAULT_RTOL = 1e-6
+
+logger = logging.getLogger(__name__)
+
+
+def get_spacy_model():
+    return '%s_%s-%s' % (nlp.meta.get('lang'), nlp.meta.get('name'), nlp.meta.get('version'))
+
+
+def compute_reference(pairs, commit=BASELINE_COMMIT):
+    """
+    Return (len(pairs), 113) matrix computed pair by pair by AllFeatureFinal of commit
+    """
+    directory = tempfile.mkdtemp()
+    worktree = os.path.join(directory, 'baseline')
+    subprocess.check_call(['git', 'worktree', 'add', '--detach', worktree, commit], cwd=APP_ROOT)
+    try:
+        pairs_path = os.path.join(directory, 'pairs.json')
+        features_path = os.path.join(directory, 'features.npy')
+        with open(pairs_path, 'w') as f:
+            json.dump(pairs, f)
+        subprocess.check_call([sys.executable, '-c', REFERENCE_SCRIPT, pairs_path, features_path], cwd=worktree)
+        return np.load(features_path)
+    finally:
+        subprocess.call(['git', 'worktree', 'remove', '--force', worktree], cwd=APP_ROOT)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def record(pairs, path=PARITY_GOLDEN, commit=BASELINE_COMMIT):
+    if get_spacy_model() != PINNED_SPACY_MODEL:
+        raise ValueError('spaCy model %s is loaded, golden vectors are recorded with %s from requirements.txt' % (
+            get_spacy_model(), PINNED_SPACY_MODEL))
+    X = compute_reference(pairs, commit)
+    np.savez_compressed(
+        path,
+        X=X,
+        s1=np.array([s1 for s1, _ in pairs]),
+        s2=np.array([s2 for _, s2 in pairs]),
+        feature_names=np.array(AllFeatureFinal().get_feature_names()),
+        features_version=np.array(FEATURES_VERSION),
+        commit=np.array(commit),
+        spacy_model=np.array(get_spacy_model()),
+    )
+    return X
+
+
+def load_golden(path=PARITY_GOLDEN):
+    with np.load(path) as data:
+        golden = {name: data[name] for name in data.files}
+    golden['pairs'] = list(zip(golden['s1'].tolist(), golden['s2'].tolist()))
+    return golden
+
+
+def with_empty_cache(compute):
+    """
+    Run compute with a fresh model.feature_cache, so that paths do not see each other's results
+    """
+    cache = model.feature_cache
+    model.feature_cache = FeatureCache(64 * 1024 * 1024, 16 * 1024 * 1024)
+    try:
+        return compute()
+    finally:
+        model.feature_cache = cache
+
+
+def get_paths(workers=None):
+    """
+    Return list of (name, function that takes pairs and feature names and returns feature matrix)
+    """
+    def single(pairs, feature_names):
+        generator = AllFeatureFinal()
+        return np.array([generator.get_features(s1, s2, feature_names) for s1, s2 in pairs])
+
+    def cached(pairs, feature_names):
+        def compute():
+            for s1, s2 in pairs:
+                model.features_for_prediction(s1, s2, feature_names)
+            # Second pass is served from the pair cache
+            return np.vstack([model.features_for_prediction(s1, s2, feature_names) for s1, s2 in pairs])
+        return with_empty_cache(compute)
+
+    def cached_sentences(pairs, feature_names):
+        def compute():
+            # Sentences are analysed once and reused by every pair they occur in, in reverse order
+            analyses = model.feature_cache.get_sentence_analyses([s for pair in pairs for s in pair])
+            generator = AllFeatureFinal()
+            X = [generator.get_features(analyses[s1], analyses[s2], feature_names) for s1, s2 in pairs[::-1]]
+            return np.array(X[::-1])
+        return with_empty_cache(compute)
+
+    def swapped(pairs, feature_names):
+        def compute():
+            for s1, s2 in pairs:
+                model.features_for_prediction(s2, s1, feature_names)
+            # Direction independent columns are taken over from the cached (s2, s1) vectors
+            return np.vstack([model.features_for_prediction(s1, s2, feature_names) for s1, s2 in pairs])
+        return with_empty_cache(compute)
+
+    def batched(pairs, feature_names):
+        return with_empty_cache(lambda: model.features_for_prediction_batch(pairs, feature_names))
+
+    def parallel(pairs, feature_names):
+        return extract_features(pairs, workers)
+
+    return [
+        ('single', single),
+        ('cached', cached),
+        ('cached_sentences', cached_sentences),
+        ('swapped', swapped),
+        ('batched', batched),
+        ('parallel', parallel),
+    ]
+
+
+def compare(golden, X, feature_names, atol=DEFAULT_ATOL, rtol=DEFAULT_RTOL):
+    """
+    Return list of (feature name, number of differing pairs, max abs difference), worst first
+    """
+    diff = np.abs(X - golden)
+    # nan == nan counts as equal
+    bad = (diff > atol + rtol * np.abs(golden)) | (np.isnan(X) != np.isnan(golden))
+    rows = []
+    for column in np.where(bad.any(axis=0))[0]:
+        column_diff = diff[:, column]
+        rows.append((
+            feature_names[column],
+            int(bad[:, column].sum()),
+            float(np.nanmax(column_diff)) if not np.isnan(column_diff).all() else float('nan'),
+        ))
+    return sorted(rows, key=lambda row: -row[1])
+
+
+def check(golden, atol=DEFAULT_ATOL, rtol=DEFAULT_RTOL, workers=None, paths=None):
+    """
+    Return dict path name -> compare result, empty list if the path agrees with golden
+    """
+    feature_names = AllFeatureFinal().get_feature_names()
+    if list(golden['feature_names']) != feature_names:
+        raise ValueError('Feature names differ from the golden file, record it again')
+    if str(golden['spacy_model']) != get_spacy_model():
+        raise ValueError('Golden file was recorded with spaCy model %s, %s is loaded, record it again' % (
+            golden['spacy_model'], get_spacy_model()))
+    if int(golden['features_version']) != FEATURES_VERSION:
+        logger.warning('Golden file has FEATURES_VERSION %d, code has %d',
+                       int(golden['features_version']), FEATURES_VERSION)
+
+    results = {}
+    for name, compute in get_paths(workers):
+        if paths is not None and name not in paths:
+            continue
+        logger.info('Checking %s', name)
+        X = np.asarray(compute(golden['pairs'], feature_names), dtype=float)
+        results[name] = compare(golden['X'], X, feature_names, atol, rtol)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Golden feature vectors of MSRP pairs')
+    parser.add_argument('command', choices=['record', 'check'])
+    parser.add_argument('--path', default=PARITY_GOLDEN)
+    parser.add_argument('--pairs', type=int, default=200, help='Number of sampled test pairs, 0 - all')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--commit', default=BASELINE_COMMIT, help='Commit whose code computes the golden vectors')
+    parser.add_argument('--atol', type=float, default=DEFAULT_ATOL)
+    parser.add_argument('--rtol', type=float, default=DEFAULT_RTOL)
+    parser.add_argument('--workers', type=int, default=None, help='Processes of the parallel path, all cores by default')
+    parser.add_argument('--only', nargs='*', default=None, help='Check only these paths')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        X = record(get_pairs(args.pairs or None, args.seed), args.path, args.commit)
+        print('Saved %d x %d vectors of %s to %s' % (X.shape[0], X.shape[1], args.commit, args.path))
+        sys.exit(0)
+
+    if not os.path.exists(args.path):
+        print('%s does not exist, run "python parity.py record" first' % args.path)
+        sys.exit(1)
+
+    results = check(load_golden(args.path), args.atol, args.rtol, args.workers, args.only)
+    print('Tolerance: |x - golden| <= %g + %g * |golden|' % (args.atol, args.rtol))
+    failed = False
+    for name, rows in results.items():
+        if not rows:
+            print('%-18s OK' % name)
+            continue
+        failed = True
+        used = [row for row in rows if row[0] in PREDICTION_FEATURE_NAMES]
+        print('%-18s %d features differ, %d of them used by the classifier' % (name, len(rows), len(used)))
+        for feature_name, count, max_diff in rows:
+            print('    %-50s %4d pairs  max diff %g%s' % (
+                feature_name, count, max_diff, '  (classifier)' if feature_name in PREDICTION_FEATURE_NAMES else '',
+            ))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Paraphrase candidate retrieval over a sentence collection.
+
+Every sentence gets an IDF weighted mean of its spaCy token vectors (the vectors the features use,
+stored as unit float16 rows) and its content words (TfIdf.use_idf) go to an inverted index
+weighted by idf. A query takes the best candidates of both, merged, and only these pairs are
+scored with the full features and model_v.
+
+    python retrieval.py build [--path sentence_index] [--input sentences.txt]
+    python retrieval.py query "sentence" [--path sentence_index] [--top-k 10] [--candidates 100]
+    python retrieval.py evaluate [--path sentence_index] [--rerank 100]
+
+build indexes all MSRP sentences without --input, evaluate reports recall of the second sentence
+of MSRP positive pairs among candidates of the first one and query times. All index arrays are
+memory mapped on load, set SENTENCE_INDEX_PATH to serve POST /api/search-sentences.
+"""
+import sys
+import os
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+import model
+from model import DataGenerator, SentenceAnalysis, feature_cache
+from bulk import predict_batch, rank
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+SENTENCE_INDEX = os.path.join(APP_ROOT, 'sentence_index')
+MODEL_V = os.path.join(APP_ROOT, 'finalized_model.sav')
+
+# Embedding rows multiplied at once, bounds memory of a query over a memory mapped index
+SEARCH_CHUNK_SIZE = 65536
+
+RECALL_AT = [1, 5, 10, 20, 50, 100]
+
+logger = logging.getLogger(__name__)
+
+
+class SentenceIndex:
+    """
+    texts, offsets - utf8 sentences concatenated, sentence i is texts[offsets[i]:offsets[i + 1]]
+    embeddings - (n, dim) float16 unit rows, zero for sentences without vectors
+    terms, term_idf, postings_indptr, postings - CSR inverted index, sorted utf8 terms,
+    ids of sentences with term i are postings[postings_indptr[i]:postings_indptr[i + 1]]
+    term_norms - Sum of idf of the terms of every sentence
+    """
+
+    ARRAYS = ['offsets', 'embeddings', 'terms', 'term_idf', 'postings_indptr', 'postings', 'term_norms']
+
+    def __init__(self, texts, offsets, embeddings, terms, term_idf, postings_indptr, postings, term_norms,
+                 idf_model=None):
+        self.texts = texts
+        self.offsets = offsets
+        self.embeddings = embeddings
+        self.terms = terms
+        self.term_idf = term_idf
+        self.postings_indptr = postings_indptr
+        self.postings = postings
+        self.term_norms = term_norms
+        self.idf_model = idf_model if idf_model is not None else model.idf_model
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_dim(self):
+        return self.embeddings.shape[1]
+
+    def get_sentence(self, index):
+        return bytes(self.texts[self.offsets[index]:self.offsets[index + 1]]).decode('utf8')
+
+    @classmethod
+    def get_embedding(cls, analysis, idf_model, dim=None):
+        """
+        Return unit float32 vector, IDF weighted mean of token vectors of SentenceAnalysis
+        """
+        vectors, has_vector = analysis.get_token_vectors()
+        if dim is not None and vectors.shape[1] != dim:
+            return np.zeros(dim, dtype=np.float32)
+
+        weights = analysis.get_node_weights(idf_model) * has_vector
+        embedding = weights.dot(vectors)
+        norm = np.sqrt((embedding ** 2).sum())
+        return embedding / norm if norm > 0 else embedding
+
+    @classmethod
+    def get_terms(cls, analysis, idf_model):
+        """
+        Return sorted distinct lowercase content words of SentenceAnalysis
+        """
+        return sorted(set(token.text.lower() for token in analysis.get_doc() if idf_model.use_idf(token)))
+
+    @classmethod
+    def build(cls, sentences, idf_model=None, batch_size=1000):
+        """
+        sentences - list of distinct sentences, index of a sentence is its id
+        """
+        if idf_model is None:
+            idf_model = model.idf_model
+
+        embeddings = []
+        term_texts = []
+        term_ids = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            analyses = SentenceAnalysis.analyse_sentences(batch)
+            for index, s in enumerate(batch, start):
+                analysis = analyses[s]
+                embeddings.append(cls.get_embedding(analysis, idf_model))
+                terms = cls.get_terms(analysis, idf_model)
+                term_texts += terms
+                term_ids += [index] * len(terms)
+            logger.info('Indexed %d / %d sentences', start + len(batch), len(sentences))
+
+        dim = max([len(embedding) for embedding in embeddings] + [0])
+        matrix = np.zeros((len(sentences), dim), dtype=np.float16)
+        for index, embedding in enumerate(embeddings):
+            if len(embedding) == dim:
+                matrix[index] = embedding
+
+        terms, inverse = np.unique(np.array([t.encode('utf8') for t in term_texts], dtype=bytes), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        postings_indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        postings_indptr[1:] = np.cumsum(np.bincount(inverse, minlength=len(terms)))
+        term_idf = idf_model.get_words_idf([t.decode('utf8') for t in terms])
+        term_norms = np.zeros(len(sentences), dtype=np.float32)
+        np.add.at(term_norms, np.array(term_ids, dtype=np.int64), term_idf[inverse])
+
+        encoded = [s.encode('utf8') for s in sentences]
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+
+        return cls(
+            np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, matrix,
+            terms, term_idf, postings_indptr, np.array(term_ids, dtype=np.int32)[order], term_norms,
+            idf_model
+        )
+
+    def save(self, path):
+        """
+        path - Directory with texts.bin, one .npy per array and meta.json
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'texts.bin'), 'wb') as f:
+            f.write(self.texts.tobytes())
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'sentences': len(self), 'dim': self.get_dim(), 'terms': len(self.terms)}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', idf_model=None):
+        texts_path = os.path.join(path, 'texts.bin')
+        if os.path.getsize(texts_path) > 0:
+            texts = np.memmap(texts_path, dtype=np.uint8, mode=mmap_mode)
+        else:
+            texts = np.zeros(0, dtype=np.uint8)
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in cls.ARRAYS]
+        return cls(texts, *arrays, idf_model=idf_model)
+
+    @classmethod
+    def get_top(cls, scores, n):
+        """
+        Return indexes of the n best positive scores, best first
+        """
+        n = min(n, int((scores > 0).sum()))
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, n - 1)[:n]
+        return top[np.argsort(-scores[top], kind='stable')]
+
+    def search_embeddings(self, embedding, n, exclude=None):
+        """
+        Return ids of n sentences with the most similar embeddings
+        """
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_CHUNK_SIZE):
+            scores[start:start + SEARCH_CHUNK_SIZE] = np.dot(
+                self.embeddings[start:start + SEARCH_CHUNK_SIZE].astype(np.float32), embedding
+            )
+        if exclude is not None:
+            scores[list(exclude)] = 0
+        return self.get_top(scores, n)
+
+    def search_terms(self, terms, n, exclude=None):
+        """
+        Return ids of n sentences sharing the most idf weight with terms
+        (sum of idf of shared terms over the geometric mean of both sums)
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        if len(terms) == 0 or len(self.terms) == 0:
+            return self.get_top(scores, n)
+
+        terms = np.array([t.encode('utf8') for t in terms], dtype=bytes)
+        index = np.minimum(np.searchsorted(self.terms, terms), len(self.terms) - 1)
+        found = index[self.terms[index] == terms]
+        for term in found:
+            scores[self.postings[self.postings_indptr[term]:self.postings_indptr[term + 1]]] += self.term_idf[term]
+
+        query_norm = self.idf_model.get_words_idf([t.decode('utf8') for t in terms]).sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(self.term_norms > 0, scores / np.sqrt(query_norm * self.term_norms), 0)
+        if exclude is not None:
+            scores[list(exclude)] = 0
+        return self.get_top(scores, n)
+
+    @classmethod
+    def merge(cls, lists, n):
+        """
+        Return first n distinct ids taking one from every list in turn
+        """
+        merged = []
+        seen = set()
+        for items in zip(*[list(items) + [None] * (n - len(items)) for items in lists]):
+            for item in items:
+                if item is not None and item not in seen:
+                    seen.add(item)
+                    merged.append(item)
+        return merged[:n]
+
+    def query(self, sentence, candidates=100, exclude=None, analysis=None):
+        """
+        Return ids of up to candidates sentences, best of the lexical and the embedding search merged
+        exclude - Optional ids to leave out, e.g. the query itself
+        """
+        if analysis is None:
+            analysis = feature_cache.get_sentence_analysis(sentence)
+        return self.merge([
+            self.search_terms(self.get_terms(analysis, self.idf_model), candidates, exclude),
+            self.search_embeddings(self.get_embedding(analysis, self.idf_model, self.get_dim()), candidates, exclude),
+        ], candidates)
+
+
+def rerank(index, sentence, candidate_ids, score_pairs, top_k=None, min_probability=None):
+    """
+    score_pairs - Function that takes list of (s1, s2) and returns get_prediction results
+    Return bulk.rank results of the candidates with their sentence id in the index
+    """
+    texts = [index.get_sentence(i) for i in candidate_ids]
+    ranked = rank(texts, score_pairs([(sentence, text) for text in texts]), top_k, min_probability)
+    for result in ranked:
+        result['id'] = int(candidate_ids[result['index']])
+    return ranked
+
+
+def search(index, sentence, score_pairs, top_k=10, candidates=100, min_probability=None):
+    """
+    Return top_k of the candidates of sentence reranked with score_pairs,
+    a sentence of the index with the same text as sentence is not its candidate
+    """
+    # One more candidate in place of the sentence itself, if it is in the index
+    candidate_ids = [i for i in index.query(sentence, candidates + 1) if index.get_sentence(i) != sentence]
+    return rerank(index, sentence, candidate_ids[:candidates], score_pairs, top_k, min_probability)
+
+
+def get_msrp_sentences():
+    data = DataGenerator.get_train_data() + DataGenerator.get_test_data()
+    return list(dict.fromkeys(s for x in data for s in (x['s1'], x['s2'])))
+
+
+def get_sentence_index():
+    """
+    Index configured with SENTENCE_INDEX_PATH, None if it is not set
+    """
+    path = os.environ.get('SENTENCE_INDEX_PATH')
+    if not path:
+        return None
+    return SentenceIndex.load(path)
+
+
+def evaluate(index, rerank_queries=0, model_v=None, max_n=max(RECALL_AT)):
+    """
+    Recall of s2 among candidates of s1 for MSRP positive pairs with both sentences in the index
+    Return dict method -> {recall: {n: recall}, ms: query time}
+    """
+    ids = {index.get_sentence(i): i for i in range(len(index))}
+    data = DataGenerator.get_train_data() + DataGenerator.get_test_data()
+    positives = [(ids[x['s1']], ids[x['s2']]) for x in data
+                 if x['label'] == 1 and x['s1'] in ids and x['s2'] in ids and x['s1'] != x['s2']]
+
+    ranks = {'embedding': [], 'lexical': [], 'combined': []}
+    times = {'analysis': 0., 'embedding': 0., 'lexical': 0., 'combined': 0.}
+    for query_id, target_id in positives:
+        t = time.perf_counter()
+        analysis = SentenceAnalysis(index.get_sentence(query_id))
+        embedding = index.get_embedding(analysis, index.idf_model, index.get_dim())
+        terms = index.get_terms(analysis, index.idf_model)
+        times['analysis'] += time.perf_counter() - t
+
+        t = time.perf_counter()
+        by_embedding = index.search_embeddings(embedding, max_n, [query_id])
+        times['embedding'] += time.perf_counter() - t
+        t = time.perf_counter()
+        by_terms = index.search_terms(terms, max_n, [query_id])
+        times['lexical'] += time.perf_counter() - t
+        t = time.perf_counter()
+        combined = index.merge([by_terms, by_embedding], max_n)
+        times['combined'] += time.perf_counter() - t
+
+        for method, found in [('embedding', by_embedding), ('lexical', by_terms), ('combined', combined)]:
+            found = list(found)
+            ranks[method].append(found.index(target_id) if target_id in found else None)
+
+    results = {}
+    for method, method_ranks in ranks.items():
+        results[method] = {
+            'recall': {n: np.mean([r is not None and r < n for r in method_ranks]) for n in RECALL_AT},
+            'ms': times[method] * 1000. / max(len(positives), 1),
+        }
+    # Merging is timed on its own, combined search runs both searches
+    results['combined']['ms'] += results['embedding']['ms'] + results['lexical']['ms']
+    results['analysis_ms'] = times['analysis'] * 1000. / max(len(positives), 1)
+    results['queries'] = len(positives)
+
+    if rerank_queries > 0 and model_v is not None:
+        sample = positives[:rerank_queries]
+        rerank_ranks = []
+        t = time.perf_counter()
+        for query_id, target_id in sample:
+            sentence = index.get_sentence(query_id)
+            ranked = [result['id'] for result in rerank(
+                index, sentence, index.query(sentence, max_n, [query_id]), lambda pairs: predict_batch(model_v, pairs)
+            )]
+            rerank_ranks.append(ranked.index(target_id) if target_id in ranked else None)
+        results['reranked'] = {
+            'recall': {n: np.mean([r is not None and r < n for r in rerank_ranks]) for n in RECALL_AT},
+            'ms': (time.perf_counter() - t) * 1000. / len(sample),
+            'queries': len(sample),
+        }
+    return results
+
+
+def print_evaluation(results):
+    print('%d queries, query analysis %.2f ms' % (results['queries'], results['analysis_ms']))
+    print('%-10s %8s  %s' % ('method', 'ms/query', '  '.join('R@%-4d' % n for n in RECALL_AT)))
+    for method in ['embedding', 'lexical', 'combined', 'reranked']:
+        if method not in results:
+            continue
+        print('%-10s %8.2f  %s' % (
+            method, results[method]['ms'], '  '.join('%.4f' % results[method]['recall'][n] for n in RECALL_AT)
+        ))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Paraphrase candidate retrieval index')
+    parser.add_argument('command', choices=['build', 'query', 'evaluate'])
+    parser.add_argument('sentence', nargs='?', default=None)
+    parser.add_argument('--path', default=SENTENCE_INDEX)
+    parser.add_argument('--input', default=None, help='File with one sentence per line, MSRP sentences by default')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--candidates', type=int, default=100, help='Candidates reranked with the classifier')
+    parser.add_argument('--rerank', type=int, default=0, help='Number of evaluated queries also reranked')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.input:
+            with open(args.input, 'r', encoding='utf8') as f:
+                sentences = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        else:
+            sentences = get_msrp_sentences()
+        t = time.time()
+        SentenceIndex.build(sentences).save(args.path)
+        print('Indexed %d sentences in %.1fs to %s' % (len(sentences), time.time() - t, args.path))
+        sys.exit(0)
+
+    from sklearn.externals import joblib
+
+    index = SentenceIndex.load(args.path)
+    model_v = joblib.load(MODEL_V)
+
+    if args.command == 'query':
+        if not args.sentence:
+            print('Usage: python retrieval.py query "sentence"')
+            sys.exit(1)
+
+        t = time.time()
+        results = search(index, args.sentence, lambda pairs: predict_batch(model_v, pairs), args.top_k, args.candidates)
+        for result in results:
+            print('%3d%%  %s' % (result['paraphrase_probability'], result['sentence']))
+        print('%.3fs' % (time.time() - t))
+    else:
+        print_evaluation(evaluate(index, args.rerank, model_v))
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded executor for feature extraction off the request thread
+and micro-batching of concurrent single-pair requests.
+
+At most workers tasks run at once and at most queue_depth more wait for a worker,
+further requests are rejected at once (Overloaded, 503) instead of piling up behind slow pairs.
+A caller waits for its task at most deadline seconds (DeadlineExceeded, 504), the task is then
+cancelled: skipped if it did not start yet, stopped at its next check of the cancelled event otherwise.
+
+MicroBatcher collects items submitted by concurrent requests for a few milliseconds (or up to max_size items)
+and processes them with one call, e.g. one nlp.pipe and one classifier call for many single pairs.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+
+
+class Overloaded(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+def get_times_stats(times):
+    times = np.array(times)
+    if len(times) == 0:
+        return {'count': 0}
+    return {
+        'count': len(times),
+        'mean': float(times.mean()),
+        'p50': float(np.percentile(times, 50)),
+        'p95': float(np.percentile(times, 95)),
+        'max': float(times.max()),
+    }
+
+
+class Task:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = threading.Event()
+        self.submitted = time.time()
+
+
+class BoundedExecutor:
+    """
+    workers - Number of threads running tasks
+    queue_depth - Max number of tasks waiting for a thread
+    deadline - Max seconds a caller waits for its task, None - no limit
+    """
+
+    # Number of recent wait and run times kept for stats
+    HISTORY_SIZE = 1000
+
+    def __init__(self, workers=1, queue_depth=8, deadline=10.):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.wait_times = deque(maxlen=self.HISTORY_SIZE)
+        self.run_times = deque(maxlen=self.HISTORY_SIZE)
+
+    def run(self, fn, *args):
+        """
+        Run fn(*args, cancelled=threading.Event) on the executor and return its result.
+        fn should return early (raise Cancelled) once the event is set.
+        Raise Overloaded if the queue is full, DeadlineExceeded if the result is not ready in time.
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded()
+
+        task = Task(fn, args)
+        with self.lock:
+            self.queued += 1
+            self.submitted += 1
+
+        future = self.executor.submit(self.execute, task)
+        try:
+            return future.result(timeout=self.deadline)
+        except TimeoutError:
+            task.cancelled.set()
+            with self.lock:
+                self.timeouts += 1
+            raise DeadlineExceeded()
+
+    def execute(self, task):
+        started = time.time()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_times.append(started - task.submitted)
+
+        try:
+            if task.cancelled.is_set():
+                raise Cancelled()
+            return task.fn(*task.args, cancelled=task.cancelled)
+        except Cancelled:
+            with self.lock:
+                self.cancelled += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.run_times.append(time.time() - started)
+            self.slots.release()
+
+    def get_stats(self):
+        with self.lock:
+            wait_times = list(self.wait_times)
+            run_times = list(self.run_times)
+            stats = {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'deadline': self.deadline,
+                'queued': self.queued,
+                'running': self.running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'cancelled': self.cancelled,
+            }
+        stats['wait_time'] = get_times_stats(wait_times)
+        stats['run_time'] = get_times_stats(run_times)
+        return stats
+
+
+class MicroBatcher:
+    """
+    process_batch - Function that takes list of items and returns list of results in the same order
+    window - Max seconds the first item of a batch waits for more items
+    max_size - Max number of items in a batch
+    """
+
+    # Number of recent batches and items kept for stats
+    HISTORY_SIZE = 1000
+
+    def __init__(self, process_batch, window=0.005, max_size=16):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.items = 0
+        self.cancelled = 0
+        self.batch_sizes = deque(maxlen=self.HISTORY_SIZE)
+        self.added_latencies = deque(maxlen=self.HISTORY_SIZE)
+        self.process_times = deque(maxlen=self.HISTORY_SIZE)
+
+    def start(self):
+        """
+        The batching thread is started on first use, so that it is not forked by gunicorn --preload
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+
+    def submit(self, item, cancelled=None):
+        """
+        Block until the batch with item is processed and return its result.
+        cancelled - Optional threading.Event, item is dropped if it is set before its batch starts
+        """
+        self.start()
+        future = Future()
+        self.queue.put((item, future, time.time(), cancelled))
+        return future.result()
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def process_items(self, items):
+        results = self.process_batch(items)
+        if len(results) != len(items):
+            raise ValueError('process_batch returned %d results for %d items' % (len(results), len(items)))
+        return results
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            started = time.time()
+
+            active = []
+            for item, future, submitted, cancelled in batch:
+                if cancelled is not None and cancelled.is_set():
+                    future.set_exception(Cancelled())
+                    with self.lock:
+                        self.cancelled += 1
+                else:
+                    active.append((item, future, submitted))
+            if len(active) == 0:
+                continue
+
+            try:
+                results = self.process_items([item for item, _, _ in active])
+            except Exception as e:
+                if len(active) == 1:
+                    active[0][1].set_exception(e)
+                else:
+                    # One bad item must not fail the requests it shares the batch with,
+                    # every item is processed on its own and gets only its own result or exception
+                    for item, future, _ in active:
+                        try:
+                            future.set_result(self.process_items([item])[0])
+                        except Exception as item_exception:
+                            future.set_exception(item_exception)
+            else:
+                for (_, future, _), result in zip(active, results):
+                    future.set_result(result)
+
+            with self.lock:
+                self.batches += 1
+                self.items += len(active)
+                self.batch_sizes.append(len(active))
+                self.added_latencies.extend(started - submitted for _, _, submitted in active)
+                self.process_times.append(time.time() - started)
+
+    def get_stats(self):
+        with self.lock:
+            batch_sizes = np.array(self.batch_sizes)
+            added_latencies = list(self.added_latencies)
+            process_times = list(self.process_times)
+            stats = {
+                'window': self.window,
+                'max_size': self.max_size,
+                'batches': self.batches,
+                'items': self.items,
+                'cancelled': self.cancelled,
+                'queued': self.queue.qsize(),
+            }
+        stats['mean_batch_size'] = float(batch_sizes.mean()) if len(batch_sizes) else 0.
+        stats['fill_rate'] = stats['mean_batch_size'] / self.max_size
+        stats['added_latency'] = get_times_stats(added_latencies)
+        stats['process_time'] = get_times_stats(process_times)
+        return stats
+
+    @classmethod
+    def test_failing_item(cls):
+        """
+        An item that fails its batch gets its own exception, the other items of the batch their results
+        """
+        batcher = cls(lambda items: [1. / item for item in items], window=0.2, max_size=4)
+        results = {}
+
+        def submit(item):
+            try:
+                results[item] = batcher.submit(item)
+            except ZeroDivisionError as e:
+                results[item] = e
+
+        threads = [threading.Thread(target=submit, args=(item,)) for item in [1, 2, 0, 4]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert batcher.get_stats()['batches'] == 1
+        assert results[1] == 1. and results[2] == .5 and results[4] == .25
+        assert isinstance(results[0], ZeroDivisionError)
+
+
+def get_serving_executor():
+    """
+    Executor configured with SERVING_QUEUE_DEPTH (unset - requests run on the request thread),
+    SERVING_WORKERS (default 1) and SERVING_DEADLINE in seconds (default 10, 0 - no deadline)
+    """
+    queue_depth = os.environ.get('SERVING_QUEUE_DEPTH')
+    if queue_depth is None:
+        return None
+
+    deadline = float(os.environ.get('SERVING_DEADLINE', 10))
+    return BoundedExecutor(
+        workers=int(os.environ.get('SERVING_WORKERS', 1)),
+        queue_depth=int(queue_depth),
+        deadline=deadline if deadline > 0 else None,
+    )
+
+
+def get_micro_batcher(process_batch):
+    """
+    Batcher configured with MICRO_BATCH_SIZE (unset - no batching)
+    and MICRO_BATCH_WINDOW in milliseconds (default 5)
+    """
+    max_size = os.environ.get('MICRO_BATCH_SIZE')
+    if max_size is None:
+        return None
+
+    return MicroBatcher(
+        process_batch,
+        window=float(os.environ.get('MICRO_BATCH_WINDOW', 5)) / 1000.,
+        max_size=int(max_size),
+    )